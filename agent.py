@@ -2,30 +2,585 @@
 
 import itertools
 import numpy as np
-from collections import namedtuple, deque
+from collections import namedtuple
+from typing import Optional
 import random
 import torch
 from torch import nn
 import copy
 import h5py
+import os
+import queue
+import json
+import threading
+import time
+import shutil
 device = torch.device("cpu") 
 import warnings
 
-Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward', 'done'))
+# minibatch drawn from replay memory; weights are the importance-sampling
+# weights of prioritized replay (None for uniform sampling), indices are
+# the memory slots the transitions were read from and discount is the 
+# per-transition factor gamma**k of n-step returns over k steps (None for
+# one-step transitions)
+Batch = namedtuple('Batch', ('state', 'action', 'next_state', 'reward', 'done', 'weights', 'indices', 'discount'))
 
+# NumPy dtypes in which replay memories store observations and rewards;
+# NumPy has no bfloat16, so bfloat16 values are kept as the upper 16 bits
+# of their float32 representation
+storage_dtypes = {'float32':np.float32, 'float16':np.float16, 'bfloat16':np.uint16}
+
+def to_bfloat16(x):
+    '''Round float32 values to bfloat16 (nearest even), returned as uint16 bits'''
+    bits = np.asarray(x, dtype=np.float32).view(np.uint32)
+    bits = bits + (0x7FFF + ((bits >> 16) & 1))
+    return (bits >> 16).astype(np.uint16)
+
+def from_bfloat16(x):
+    return (np.asarray(x, dtype=np.uint32) << 16).view(np.float32)
+
+'''
+    Replay memory with preallocated, contiguous NumPy columns for state,
+    action, next_state, reward and done. New transitions overwrite the oldest
+    ones once the memory is full (ring buffer).
+
+    dtype ('float32', 'float16' or 'bfloat16') is the precision in which 
+    observations and rewards are stored; sampled batches are always 
+    converted to float32.
+
+    With n_step > 1, sampled transitions are n-step transitions: the rewards
+    of up to n_step consecutive transitions of the same trajectory are 
+    summed with discount_factor, and next_state and done are those of the 
+    last of them. Trajectories are followed through the ring buffer at 
+    sample time, vectorized over the batch. Consecutive transitions of a 
+    trajectory are trajectory_stride slots apart, which is the number of 
+    sub-environments when a batched environment pushes one block per step.
+'''
 class memory(object):
 
-    def __init__(self, capacity):
-        self.memory = deque([],maxlen=capacity)
+    trajectory_stride = 1 # slots between consecutive transitions of a trajectory
+
+    def __init__(self, capacity, n_state, dtype='float32', n_step=1, discount_factor=0.99):
+        self.capacity = int(capacity)
+        self.n_state = int(n_state)
+        self.dtype = dtype
+        self.n_step = int(n_step)
+        self.discount_factor = discount_factor
+        storage_dtype = storage_dtypes[dtype]
+        self.state = np.zeros((self.capacity, self.n_state), dtype=storage_dtype)
+        self.action = np.zeros(self.capacity, dtype=np.int64)
+        self.next_state = np.zeros((self.capacity, self.n_state), dtype=storage_dtype)
+        self.reward = np.zeros(self.capacity, dtype=storage_dtype)
+        self.done = np.zeros(self.capacity, dtype=np.float32)
+        self.position = 0 # index at which the next transition is written
+        self.size = 0 # number of transitions currently stored
+
+    def encode(self, x):
+        '''Convert observations or rewards to the storage dtype'''
+        if self.dtype == 'bfloat16':
+            return to_bfloat16(x)
+        elif self.dtype == 'float16':
+            return np.asarray(x, dtype=np.float16)
+        return np.asarray(x, dtype=np.float32)
+
+    def decode(self, x):
+        '''Convert stored observations or rewards to float32'''
+        if self.dtype == 'bfloat16':
+            return from_bfloat16(x)
+        elif self.dtype == 'float16':
+            return x.astype(np.float32)
+        return x
+
+    @property
+    def nbytes(self):
+        '''Memory footprint of the preallocated columns in bytes'''
+        return sum(column.nbytes for column in vars(self).values()
+                   if isinstance(column, np.ndarray) and column.ndim > 0)
+
+    def push(self, state, action, next_state, reward, done):
+        i = self.position
+        self.state[i] = self.encode(state)
+        self.action[i] = action
+        self.next_state[i] = self.encode(next_state)
+        self.reward[i] = self.encode(reward)
+        self.done[i] = done
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def push_batch(self, states, actions, next_states, rewards, dones):
+        n = len(actions)
+        indices = (self.position + np.arange(n)) % self.capacity
+        self.state[indices] = self.encode(states)
+        self.action[indices] = actions
+        self.next_state[indices] = self.encode(next_states)
+        self.reward[indices] = self.encode(rewards)
+        self.done[indices] = dones
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return indices
+
+    def sample_indices(self, batch_size):
+        indices = np.random.randint(0, self.size, size=batch_size)
+        return indices, None
+
+    def state_dict(self):
+        '''Return the stored transitions and the write position as NumPy arrays'''
+        return {'state':self.state[:self.size],
+                'action':self.action[:self.size],
+                'next_state':self.next_state[:self.size],
+                'reward':self.reward[:self.size],
+                'done':self.done[:self.size],
+                'position':np.array(self.position),
+                'size':np.array(self.size)}
+
+    def load_state_dict(self, state_dict):
+        self.size = int(state_dict['size'])
+        self.position = int(state_dict['position'])
+        for name in ['state', 'action', 'next_state', 'reward', 'done']:
+            getattr(self, name)[:self.size] = state_dict[name]
+
+    def continues(self, previous, current):
+        '''True where slot current holds the transition that follows the one in slot previous'''
+        # counted from the write position, slots written later have larger
+        # offsets (unwritten slots of a memory that is not full yet have 
+        # smaller ones); the trajectory must not have terminated and current
+        # must start where previous ended
+        offset = (current - self.position) % self.capacity
+        previous_offset = (previous - self.position) % self.capacity
+        return ((offset > previous_offset)
+                & (self.done[previous] == 0)
+                & (self.state[current] == self.next_state[previous]).all(axis=-1))
+
+    def get_n_step_returns(self, indices):
+        '''
+        Return n-step rewards, the slots of the last transition of each 
+        n-step transition and the discount factors gamma**k
+        '''
+        steps = (indices[:,None] + self.trajectory_stride*np.arange(self.n_step)) % self.capacity
+        in_trajectory = np.ones(steps.shape, dtype=bool)
+        in_trajectory[:,1:] = self.continues(steps[:,:-1], steps[:,1:])
+        in_trajectory = np.logical_and.accumulate(in_trajectory, axis=1)
+        discounts = self.discount_factor**np.arange(self.n_step, dtype=np.float32)
+        rewards = (self.decode(self.reward[steps]) * discounts * in_trajectory).sum(axis=1)
+        n_steps = in_trajectory.sum(axis=1)
+        last = steps[np.arange(len(indices)), n_steps - 1]
+        discount = (self.discount_factor**n_steps).astype(np.float32)
+        return rewards.astype(np.float32), last, discount
+
+    def get_batch(self, indices, weights=None):
+        # a single fancy-index gather per column; torch.from_numpy wraps the
+        # gathered arrays without copying them again
+        if weights is not None:
+            weights = torch.from_numpy(weights)
+        if self.n_step == 1:
+            return Batch(torch.from_numpy(self.decode(self.state[indices])),
+                         torch.from_numpy(self.action[indices]),
+                         torch.from_numpy(self.decode(self.next_state[indices])),
+                         torch.from_numpy(self.decode(self.reward[indices])),
+                         torch.from_numpy(self.done[indices]),
+                         weights,
+                         indices,
+                         None)
+        rewards, last, discount = self.get_n_step_returns(indices)
+        return Batch(torch.from_numpy(self.decode(self.state[indices])),
+                     torch.from_numpy(self.action[indices]),
+                     torch.from_numpy(self.decode(self.next_state[last])),
+                     torch.from_numpy(rewards),
+                     torch.from_numpy(self.done[last]),
+                     weights,
+                     indices,
+                     torch.from_numpy(discount))
 
-    def push(self, *args):
-        self.memory.append(Transition(*args))
+    def sample(self, batch_size, n_batches=1):
+        '''
+        Sample batch_size transitions, or n_batches minibatches of batch_size
+        transitions at once that split_batch separates again
+        '''
+        indices, weights = self.sample_indices(batch_size=batch_size*n_batches)
+        if n_batches > 1:
+            # minibatch k gets every n_batches-th sample, which keeps the 
+            # stratification of prioritized sampling within each minibatch
+            order = np.arange(batch_size*n_batches).reshape(batch_size, n_batches).T.reshape(-1)
+            indices = indices[order]
+            if weights is not None:
+                weights = weights[order]
+        return self.get_batch(indices=indices, weights=weights)
 
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+    def flush(self):
+        pass # nothing to write, the columns live in RAM
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+
+'''
+    Replay memory whose columns are np.memmap'ed .npy files in directory, for
+    capacities that do not fit into RAM. The operating system pages the 
+    columns in and out as needed, so resident memory stays flat regardless
+    of capacity. Write position and size are kept in meta.json, which is
+    updated by flush.
+
+    mode is 'w+' to create a new memory (existing files are overwritten),
+    'r+' to reopen an existing one for further pushes, and 'r' to reopen it
+    read-only, e.g. for sampling in other processes while a writer keeps 
+    filling it; such readers pick up new transitions with refresh after 
+    the writer called flush.
+'''
+class memmap_memory(memory):
+
+    columns = ['state', 'action', 'next_state', 'reward', 'done']
+
+    def __init__(self, capacity, n_state, directory, mode='w+', dtype='float32',
+                 n_step=1, discount_factor=0.99):
+        self.capacity = int(capacity)
+        self.n_state = int(n_state)
+        self.directory = directory
+        self.mode = mode
+        self.dtype = dtype
+        self.n_step = int(n_step)
+        self.discount_factor = discount_factor
+        storage_dtype = storage_dtypes[dtype]
+        if mode == 'w+':
+            os.makedirs(directory, exist_ok=True)
+            shapes = {'state':((self.capacity, self.n_state), storage_dtype),
+                      'action':((self.capacity,), np.int64),
+                      'next_state':((self.capacity, self.n_state), storage_dtype),
+                      'reward':((self.capacity,), storage_dtype),
+                      'done':((self.capacity,), np.float32)}
+            for name, (shape, dtype) in shapes.items():
+                setattr(self, name, np.lib.format.open_memmap(self.get_filename(name),
+                                        mode='w+', dtype=dtype, shape=shape))
+            self.position = 0
+            self.size = 0
+            self.flush()
+        else:
+            for name in self.columns:
+                setattr(self, name, np.load(self.get_filename(name), mmap_mode=mode))
+            if self.state.shape != (self.capacity, self.n_state) or self.state.dtype != storage_dtype:
+                raise RuntimeError(f"Replay memory in {directory} has shape {self.state.shape} and dtype {self.state.dtype}, "
+                                   f"expected {(self.capacity, self.n_state)} and {dtype}.")
+            self.refresh()
+
+    @classmethod
+    def open(cls, directory, mode='r'):
+        '''Reopen an existing memory, taking capacity and n_state from its files'''
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        return cls(capacity=meta['capacity'], n_state=meta['n_state'],
+                   directory=directory, mode=mode, dtype=meta.get('dtype', 'float32'))
+
+    def get_filename(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def flush(self):
+        '''Write the columns and position and size of the memory to disk'''
+        for name in self.columns:
+            getattr(self, name).flush()
+        meta = {'capacity':self.capacity, 'n_state':self.n_state, 'dtype':self.dtype,
+                'position':self.position, 'size':self.size}
+        filename = os.path.join(self.directory, 'meta.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(filename + '.tmp', filename)
+
+    def refresh(self):
+        '''Read position and size as last flushed by the writer'''
+        with open(os.path.join(self.directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.position = meta['position']
+        self.size = meta['size']
+
+    def sample_indices(self, batch_size):
+        # sorted indices turn the gather into one forward pass over the files
+        indices = np.sort(np.random.randint(0, self.size, size=batch_size))
+        return indices, None
+
+
+'''
+    Replay memory that stores each observation only once. Slot i holds the
+    observation, action, reward and done of a transition whose next_state is
+    the observation in slot i+1, so next_state is reconstructed by index
+    arithmetic instead of being stored twice. After each push the next_state
+    is written to the following slot, where the next transition of the same
+    episode starts. If the next pushed state is a different one (new episode
+    after a reset), that slot is left as an invalid filler that only holds 
+    the final observation of the previous episode. valid marks the slots 
+    that start a transition; only those are sampled.
+
+    This halves the memory needed for observations when consecutive pushes
+    continue the same trajectory (single environment, or chunks of one 
+    actor's trajectory in train_actor_learner). Interleaved transitions of 
+    several environments need two slots each, so capacity counts slots 
+    rather than transitions.
+'''
+class deduplicated_memory(memory):
+
+    def __init__(self, capacity, n_state, dtype='float32', n_step=1, discount_factor=0.99):
+        self.capacity = int(capacity)
+        self.n_state = int(n_state)
+        self.dtype = dtype
+        self.n_step = int(n_step)
+        self.discount_factor = discount_factor
+        storage_dtype = storage_dtypes[dtype]
+        self.observation = np.zeros((self.capacity, self.n_state), dtype=storage_dtype)
+        self.action = np.zeros(self.capacity, dtype=np.int64)
+        self.reward = np.zeros(self.capacity, dtype=storage_dtype)
+        self.done = np.zeros(self.capacity, dtype=np.float32)
+        self.valid = np.zeros(self.capacity, dtype=bool)
+        self.position = 0 # slot holding the next_state of the last transition
+        self.size = 0 # number of slots in use
+        self.n_transitions = 0 # number of valid slots
+        self.continuing = False # True if observation[position] is the next_state of the last push
+
+    def advance(self):
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        if self.valid[self.position]: # the oldest transition is overwritten
+            self.valid[self.position] = False
+            self.n_transitions -= 1
+
+    def push(self, state, action, next_state, reward, done):
+        state = self.encode(state)
+        if not (self.continuing and np.array_equal(self.observation[self.position], state)):
+            if self.continuing: # keep the final observation of the last trajectory
+                self.advance()
+            self.observation[self.position] = state
+        i = self.position
+        self.action[i] = action
+        self.reward[i] = self.encode(reward)
+        self.done[i] = done
+        self.valid[i] = True
+        self.n_transitions += 1
+        if self.size == 0:
+            self.size = 1
+        self.advance()
+        self.observation[self.position] = self.encode(next_state)
+        self.continuing = True
+
+    def push_batch(self, states, actions, next_states, rewards, dones):
+        indices = np.empty(len(actions), dtype=np.int64)
+        for k in range(len(actions)):
+            self.push(states[k], actions[k], next_states[k], rewards[k], dones[k])
+            indices[k] = (self.position - 1) % self.capacity
+        return indices
+
+    def sample_indices(self, batch_size):
+        indices = np.random.randint(0, self.size, size=batch_size)
+        invalid = ~self.valid[indices]
+        while invalid.any(): # resample fillers, a small fraction of the slots
+            indices[invalid] = np.random.randint(0, self.size, size=int(invalid.sum()))
+            invalid = ~self.valid[indices]
+        return indices, None
+
+    def continues(self, previous, current):
+        # a valid slot that follows a valid one always starts at its next_state
+        return self.valid[current] & (self.done[previous] == 0)
+
+    def get_batch(self, indices, weights=None):
+        if weights is not None:
+            weights = torch.from_numpy(weights)
+        if self.n_step == 1:
+            rewards = self.decode(self.reward[indices])
+            last = indices
+            discount = None
+        else:
+            rewards, last, discount = self.get_n_step_returns(indices)
+            discount = torch.from_numpy(discount)
+        return Batch(torch.from_numpy(self.decode(self.observation[indices])),
+                     torch.from_numpy(self.action[indices]),
+                     torch.from_numpy(self.decode(self.observation[(last + 1) % self.capacity])),
+                     torch.from_numpy(rewards),
+                     torch.from_numpy(self.done[last]),
+                     weights,
+                     indices,
+                     discount)
+
+    def state_dict(self):
+        return {'observation':self.observation[:self.size],
+                'action':self.action[:self.size],
+                'reward':self.reward[:self.size],
+                'done':self.done[:self.size],
+                'valid':self.valid[:self.size],
+                'position':np.array(self.position),
+                'size':np.array(self.size),
+                'continuing':np.array(self.continuing)}
+
+    def load_state_dict(self, state_dict):
+        self.size = int(state_dict['size'])
+        self.position = int(state_dict['position'])
+        self.continuing = bool(state_dict['continuing'])
+        for name in ['observation', 'action', 'reward', 'done', 'valid']:
+            getattr(self, name)[:self.size] = state_dict[name]
+        self.n_transitions = int(self.valid.sum())
+
+    def __len__(self):
+        return self.n_transitions
+
+
+'''
+    Binary sum-tree over a power-of-two number of leaves, stored as a flat
+    array (node k has children 2k and 2k+1, the root is node 1). Updates and
+    proportional lookups take O(log n) and are vectorized over a batch.
+'''
+class sum_tree(object):
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.n_leaves = 1 << max(self.capacity - 1, 0).bit_length()
+        self.tree = np.zeros(2*self.n_leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[np.asarray(indices) + self.n_leaves]
+
+    def update_single(self, index, value):
+        node = int(index) + self.n_leaves
+        tree = self.tree
+        tree[node] = value
+        node >>= 1
+        while node > 0:
+            tree[node] = tree[2*node] + tree[2*node+1]
+            node >>= 1
+
+    def update(self, indices, values):
+        if len(indices) == 0:
+            return
+        nodes = np.asarray(indices, dtype=np.int64) + self.n_leaves
+        self.tree[nodes] = values
+        nodes = np.unique(nodes >> 1)
+        while nodes[0] > 0: # all nodes are on the same level of the tree
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes+1]
+            nodes = np.unique(nodes >> 1)
+
+    def find(self, values):
+        '''Return the leaf indices at which the prefix sums reach values'''
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.n_leaves:
+            left = 2*nodes
+            left_sum = self.tree[left]
+            go_right = values >= left_sum
+            values = np.where(go_right, values - left_sum, values)
+            nodes = left + go_right
+        return nodes - self.n_leaves
+
+
+'''
+    Prioritized experience replay (Schaul et al., 2015) with proportional
+    sampling. Priorities p_i = (|TD error| + epsilon)^alpha live in a sum-tree,
+    sampling is stratified over batch_size equal segments of the total
+    priority, and the importance-sampling exponent beta is annealed to 1.
+'''
+class prioritized_memory(memory):
+
+    def __init__(self, capacity, n_state, alpha=0.6, beta=0.4,
+                        beta_increment=1e-4, epsilon=1e-6, dtype='float32',
+                        n_step=1, discount_factor=0.99):
+        super().__init__(capacity=capacity, n_state=n_state, dtype=dtype,
+                         n_step=n_step, discount_factor=discount_factor)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.tree = sum_tree(self.capacity)
+        self.max_priority = 1.0 # new transitions get the largest priority seen
+
+    def push(self, state, action, next_state, reward, done):
+        i = self.position
+        super().push(state, action, next_state, reward, done)
+        self.tree.update_single(i, self.max_priority**self.alpha)
+
+    def push_batch(self, states, actions, next_states, rewards, dones):
+        indices = super().push_batch(states, actions, next_states, rewards, dones)
+        self.tree.update(indices, self.max_priority**self.alpha)
+        return indices
+
+    def state_dict(self):
+        state_dict = super().state_dict()
+        state_dict['priorities'] = self.tree.get(np.arange(self.size))
+        state_dict['beta'] = np.array(self.beta)
+        state_dict['max_priority'] = np.array(self.max_priority)
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        self.tree.update(np.arange(self.size), state_dict['priorities'])
+        self.beta = float(state_dict['beta'])
+        self.max_priority = float(state_dict['max_priority'])
+
+    def sample_indices(self, batch_size):
+        total = self.tree.total()
+        segment = total / batch_size
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+        indices = self.tree.find(np.minimum(values, total*(1. - 1e-12)))
+        indices = np.minimum(indices, self.size - 1) # guard against round-off
+        probabilities = self.tree.get(indices) / total
+        weights = (self.size * probabilities)**(-self.beta)
+        weights = (weights / weights.max()).astype(np.float32)
+        self.beta = min(1., self.beta + self.beta_increment)
+        return indices, weights
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities**self.alpha)
+
+
+'''
+    Background sampler that keeps up to n_batches minibatches of batch_size
+    transitions ready in a bounded queue, so that sampling, gathering and 
+    tensor conversion overlap with the gradient step of the learner. lock 
+    must be held by everyone who modifies memory (pushes, priority updates)
+    while the sampler runs. With prioritized replay, the priorities of a 
+    prefetched batch are at most n_batches gradient steps old.
+'''
+class batch_prefetcher(object):
+
+    def __init__(self, memory, batch_size, lock, n_batches=2, n_minibatches=1):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.n_minibatches = n_minibatches # per batch, see memory.sample
+        self.lock = lock
+        self.batches = queue.Queue(maxsize=n_batches)
+        self.stopped = threading.Event()
+        self.sampler_error = None
+        self.sampler = threading.Thread(target=self.run_sampler, daemon=True)
+        self.sampler.start()
+
+    def run_sampler(self):
+        try:
+            while not self.stopped.is_set():
+                with self.lock:
+                    batch = None
+                    if len(self.memory) >= self.batch_size:
+                        batch = self.memory.sample(batch_size=self.batch_size,
+                                                   n_batches=self.n_minibatches)
+                if batch is None: # wait for the memory to fill up
+                    time.sleep(1e-3)
+                    continue
+                while not self.stopped.is_set():
+                    try:
+                        self.batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            self.sampler_error = error
+
+    def get(self):
+        '''Return the next minibatch, waiting for the sampler if none is ready'''
+        while True:
+            try:
+                return self.batches.get(timeout=0.1)
+            except queue.Empty:
+                if self.sampler_error is not None:
+                    raise RuntimeError("Sampling from replay memory failed.") from self.sampler_error
+
+    def close(self):
+        self.stopped.set()
+        self.sampler.join()
 
 
 '''
@@ -52,6 +607,445 @@ class neural_network(nn.Module):
             x = layer(x)
         return x
 
+def run_actor(environment_fn, layers, n_actions, shared_state_dict, weights_lock,
+              weights_version, epsilon, transition_queue, stop_event,
+              chunk_size, seed):
+    """
+    Actor process of agent_base.train_actor_learner: steps its own
+    environment with an epsilon-greedy copy of the policy net and sends
+    (states, actions, next_states, rewards, dones, finished_episodes) chunks
+    to the learner, where finished_episodes is a list of (duration, return)
+    """
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    environment = environment_fn()
+    policy_net = neural_network(layers)
+    policy_net.eval()
+    local_version = -1
+    n_state = layers[0]
+    
+    states = np.zeros((chunk_size, n_state), dtype=np.float32)
+    actions = np.zeros(chunk_size, dtype=np.int64)
+    next_states = np.zeros((chunk_size, n_state), dtype=np.float32)
+    rewards = np.zeros(chunk_size, dtype=np.float32)
+    dones = np.zeros(chunk_size, dtype=np.float32)
+    
+    state, info = environment.reset(seed=seed)
+    n_transitions = 0
+    current_total_reward = 0.
+    current_duration = 0
+    
+    while not stop_event.is_set():
+        if weights_version.value != local_version:
+            with weights_lock:
+                policy_net.load_state_dict(shared_state_dict)
+                local_version = weights_version.value
+        
+        if np.random.rand() > epsilon.value:
+            with torch.inference_mode():
+                action = int(policy_net(torch.from_numpy(
+                            np.asarray(state, dtype=np.float32))).argmax(0))
+        else:
+            action = np.random.randint(n_actions)
+        next_state, reward, terminated, truncated, info = environment.step(action)
+        done = terminated or truncated
+        current_total_reward += reward
+        current_duration += 1
+        
+        states[n_transitions] = state
+        actions[n_transitions] = action
+        next_states[n_transitions] = next_state
+        rewards[n_transitions] = reward
+        dones[n_transitions] = done
+        n_transitions += 1
+        
+        finished_episodes = []
+        if done:
+            finished_episodes.append((current_duration, current_total_reward))
+            current_total_reward = 0.
+            current_duration = 0
+            state, info = environment.reset()
+        else:
+            state = next_state
+        
+        if n_transitions == chunk_size or done:
+            # tensors sent through a torch.multiprocessing queue are moved to
+            # shared memory instead of being pickled
+            chunk = (torch.from_numpy(states[:n_transitions].copy()),
+                     torch.from_numpy(actions[:n_transitions].copy()),
+                     torch.from_numpy(next_states[:n_transitions].copy()),
+                     torch.from_numpy(rewards[:n_transitions].copy()),
+                     torch.from_numpy(dones[:n_transitions].copy()),
+                     finished_episodes)
+            while not stop_event.is_set():
+                try:
+                    transition_queue.put(chunk, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            n_transitions = 0
+
+
+'''
+    Model snapshots written during training. Every snapshot is saved to its
+    own file in directory and listed in an index (index.json) together with
+    the episode and the minimal and mean return of the last episodes, so
+    each save only writes the new snapshot. After each save, the retention
+    policy keeps the newest snapshot, the last keep_last snapshots and the
+    best keep_best snapshots by mean return (all snapshots if both are 
+    None). Snapshots taken before n_solving_episodes episodes have no mean
+    return and rank last.
+
+    With asynchronous=True, snapshots are serialized and fsynced by a
+    background writer thread. At most queue_depth snapshots wait to be
+    written; save blocks while the queue is full (backpressure). Call close
+    (or flush) before reading the snapshots back.
+'''
+class checkpoint_store(object):
+
+    index_filename = 'index.json'
+
+    def __init__(self, directory, keep_last=None, keep_best=None,
+                 asynchronous=False, queue_depth=2):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        os.makedirs(self.directory, exist_ok=True)
+        self.index = {} # episode -> index entry
+        index_path = os.path.join(self.directory, self.index_filename)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for entry in json.load(f):
+                    self.index[entry['episode']] = entry
+        
+        self.writer = None
+        self.writer_error = None
+        if asynchronous:
+            self.jobs = queue.Queue(maxsize=queue_depth)
+            self.writer = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer.start()
+
+    def save(self, n_episode, state, min_return=None, mean_return=None):
+        job = {'n_episode':n_episode, 'state':state,
+               'min_return':min_return, 'mean_return':mean_return}
+        if self.writer is None:
+            self.write_snapshot(**job)
+        else:
+            self.raise_writer_error()
+            self.jobs.put(job) # blocks while queue_depth snapshots are pending
+
+    def run_writer(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self.write_snapshot(**job)
+            except Exception as error:
+                self.writer_error = error
+            finally:
+                self.jobs.task_done()
+
+    def raise_writer_error(self):
+        if self.writer_error is not None:
+            error, self.writer_error = self.writer_error, None
+            raise RuntimeError("Writing a snapshot to {0} failed.".format(self.directory)) from error
+
+    def flush(self):
+        '''Wait until all pending snapshots are written'''
+        if self.writer is not None:
+            self.jobs.join()
+        self.raise_writer_error()
+
+    def close(self):
+        if self.writer is not None:
+            self.jobs.put(None)
+            self.writer.join()
+            self.writer = None
+        self.raise_writer_error()
+
+    def write_snapshot(self, n_episode, state, min_return, mean_return):
+        filename = f'episode_{n_episode:07d}.pt'
+        self.write_atomically(filename=filename,
+                              write=lambda f: torch.save(state, f))
+        self.add_to_index(n_episode=n_episode, filename=filename,
+                          min_return=min_return, mean_return=mean_return)
+
+    def add_to_index(self, n_episode, filename, min_return, mean_return):
+        self.index[n_episode] = {'episode':int(n_episode),
+                                 'filename':filename,
+                                 'min_return':None if min_return is None else float(min_return),
+                                 'mean_return':None if mean_return is None else float(mean_return)}
+        self.apply_retention_policy()
+        entries = [self.index[episode] for episode in self.episodes()]
+        self.write_atomically(filename=self.index_filename, mode='w',
+                              write=lambda f: json.dump(entries, f, indent=1))
+
+    def write_atomically(self, filename, write, mode='wb'):
+        path = os.path.join(self.directory, filename)
+        with open(path + '.tmp', mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def apply_retention_policy(self):
+        if self.keep_last is None and self.keep_best is None:
+            return
+        episodes = self.episodes()
+        keep = set(episodes[-1:]) # the newest snapshot is always kept
+        if self.keep_last is not None:
+            keep.update(episodes[len(episodes)-self.keep_last:] if self.keep_last > 0 else [])
+        if self.keep_best is not None:
+            ranked = sorted(episodes, key=self.get_mean_return)
+            keep.update(ranked[len(ranked)-self.keep_best:] if self.keep_best > 0 else [])
+        for episode in episodes:
+            if episode not in keep:
+                entry = self.index.pop(episode)
+                try:
+                    os.remove(os.path.join(self.directory, entry['filename']))
+                except FileNotFoundError:
+                    pass
+
+    def episodes(self):
+        return sorted(self.index.keys())
+
+    def get_mean_return(self, n_episode):
+        mean_return = self.index[n_episode]['mean_return']
+        return -np.inf if mean_return is None else mean_return
+
+    def best_episode(self):
+        '''Return the episode of the snapshot with the highest mean return'''
+        return max(self.episodes(), key=self.get_mean_return)
+
+    def load(self, n_episode=None):
+        '''Return the snapshot of episode n_episode (default: latest snapshot)'''
+        if n_episode is None:
+            n_episode = self.episodes()[-1]
+        try:
+            filename = self.index[n_episode]['filename']
+        except KeyError:
+            raise RuntimeError(f"No snapshot for episode {n_episode} in {self.directory}.")
+        return torch.load(os.path.join(self.directory, filename), weights_only=False)
+
+
+'''
+    HDF5 log of the training results. Every list in the training results
+    (episode durations, returns, ...) is stored as a chunked, resizable
+    dataset that append extends in place by the episodes added since the
+    previous append. With swmr=True the file is in single-writer/multiple-
+    reader mode, so a monitoring process can follow a running training via
+        h5py.File(filename, 'r', libver='latest', swmr=True)
+    and refresh() on the datasets.
+'''
+class training_log(object):
+
+    datasets = {'episode_durations':np.int64,
+                'epsiode_returns':np.float64,
+                'n_training_epochs':np.int64,
+                'n_steps_simulated':np.int64,}
+
+    def __init__(self, filename, compression=None, swmr=False, chunk_size=1024):
+        self.file = h5py.File(filename, 'w', libver='latest' if swmr else 'earliest')
+        for key, dtype in self.datasets.items():
+            self.file.create_dataset(key, shape=(0,), maxshape=(None,),
+                                     chunks=(chunk_size,), dtype=dtype,
+                                     compression=compression)
+        # all datasets have to exist before switching to SWMR mode
+        self.file.create_dataset('training_completed', data=False)
+        if swmr:
+            self.file.swmr_mode = True
+        self.n_written = 0 # number of episodes already written to the file
+
+    def append(self, training_results):
+        n_episodes = len(training_results['episode_durations'])
+        if n_episodes > self.n_written:
+            for key in self.datasets.keys():
+                dataset = self.file[key]
+                dataset.resize((n_episodes,))
+                dataset[self.n_written:n_episodes] = training_results[key][self.n_written:n_episodes]
+            self.n_written = n_episodes
+        self.file['training_completed'][()] = training_results['training_completed']
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+'''
+    Cumulative wall time and number of calls for each phase of the training
+    loop. Phases are timed by chaining
+        t = timer.now()
+        ...
+        t = timer.record('phase', t)
+    which adds the time since t to the phase and returns the current time.
+'''
+class phase_timer(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total_time = {}
+        self.n_calls = {}
+
+    def now(self):
+        return time.perf_counter()
+
+    def record(self, phase, start_time):
+        now = time.perf_counter()
+        self.total_time[phase] = self.total_time.get(phase, 0.) + now - start_time
+        self.n_calls[phase] = self.n_calls.get(phase, 0) + 1
+        return now
+
+    def get_summary(self):
+        return {phase: {'total_time':total_time,
+                        'n_calls':self.n_calls[phase],
+                        'mean_time':total_time/self.n_calls[phase]}
+                for phase, total_time in self.total_time.items()}
+
+    def format_summary(self):
+        total_time = sum(self.total_time.values())
+        return "| timing: " + ", ".join(
+                    "{0} {1:.1f}% ({2:.3f} ms/call)".format(phase, 
+                        100*self.total_time[phase]/total_time, 
+                        1e3*self.total_time[phase]/self.n_calls[phase])
+                    for phase in sorted(self.total_time, key=self.total_time.get, reverse=True))
+
+
+'''
+    Stand-in for phase_timer when the training loop is not profiled
+'''
+class null_timer(object):
+
+    def reset(self):
+        pass
+
+    def now(self):
+        return 0.
+
+    def record(self, phase, start_time):
+        return 0.
+
+    def get_summary(self):
+        return {}
+
+    def format_summary(self):
+        return ""
+
+
+def dqn_loss(q_values: torch.Tensor, actions: torch.Tensor, next_q_target: torch.Tensor,
+             next_q_policy: Optional[torch.Tensor], reward: torch.Tensor, done: torch.Tensor,
+             discount: torch.Tensor, weights: Optional[torch.Tensor]):
+    '''
+    Return the (importance-weighted) mean squared TD error together with the
+    Q values of the taken actions (LHS) and the Bellman targets (RHS). With
+    next_q_policy (double DQN) the target net evaluates the greedy actions 
+    of the policy net.
+    '''
+    LHS = q_values.gather(dim=1, index=actions.unsqueeze(1))
+    if next_q_policy is None:
+        Q_next_state = next_q_target.max(1)[0]
+    else:
+        Q_next_state = next_q_target.gather(dim=1, index=next_q_policy.argmax(dim=1).unsqueeze(1)).squeeze(1)
+    RHS = (Q_next_state * discount * (1.-done) + reward).unsqueeze(1)
+    if weights is None:
+        loss = ((LHS - RHS)**2).mean()
+    else:
+        loss = (weights.unsqueeze(1) * (LHS - RHS)**2).mean()
+    return loss, LHS, RHS
+
+
+'''
+    Callable that runs a compiled function and, if that raises (e.g. 
+    torch.compile without a working C++ compiler), warns once and runs the
+    eager function from then on.
+'''
+class eager_fallback(object):
+
+    def __init__(self, compiled, eager, name):
+        self.compiled = compiled
+        self.eager = eager
+        self.name = name
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception as error:
+                warnings.warn(f"Compiled {self.name} failed ({type(error).__name__}: {error}), "
+                              "falling back to eager PyTorch.")
+                self.compiled = None
+        return self.eager(*args)
+
+
+def split_batch(batch, n_batches):
+    '''Split a batch sampled with memory.sample(batch_size, n_batches) into its minibatches'''
+    fields = [None if field is None
+              else field.chunk(n_batches) if isinstance(field, torch.Tensor)
+              else np.split(field, n_batches) for field in batch]
+    return [Batch(*[None if field is None else field[k] for field in fields])
+            for k in range(n_batches)]
+
+
+def clone_state_dict(state_dict):
+    '''
+    Return a snapshot of a (nested) state dict in which all tensors are
+    detached CPU copies. Cheaper than copy.deepcopy, which goes through the
+    pickling machinery for every tensor.
+    '''
+    if isinstance(state_dict, torch.Tensor):
+        return state_dict.detach().to('cpu', copy=True)
+    elif isinstance(state_dict, dict):
+        return {key: clone_state_dict(value) for key, value in state_dict.items()}
+    elif isinstance(state_dict, (list, tuple)):
+        return type(state_dict)(clone_state_dict(value) for value in state_dict)
+    return copy.deepcopy(state_dict)
+
+
+def export_numpy_policy(state, filename, network='policy_net'):
+    '''
+    Write the weights of a network from a state (see agent_base.get_state) 
+    as plain NumPy arrays weight_0, bias_0, weight_1, ... to the .npz file
+    filename, for inference with numpy_policy.numpy_policy. The weights are
+    stored transposed, with shape (n_in, n_out).
+    '''
+    state_dict = state[network]
+    layer_indices = sorted({int(key.split('.')[1]) for key in state_dict})
+    arrays = {}
+    for i, layer_index in enumerate(layer_indices):
+        prefix = f'network_layers.{layer_index}.'
+        arrays[f'weight_{i}'] = state_dict[prefix + 'weight'].detach().cpu().numpy().T.astype(np.float32)
+        arrays[f'bias_{i}'] = state_dict[prefix + 'bias'].detach().cpu().numpy().astype(np.float32)
+    np.savez(filename, **arrays)
+
+
+def is_vector_environment(environment):
+    '''
+    True for batched environments that provide num_envs. The check goes 
+    through unwrapped, since attribute lookups on gymnasium wrappers that
+    fall through to the environment are deprecated and warn.
+    '''
+    return hasattr(getattr(environment, 'unwrapped', environment), 'num_envs')
+
+
+def flatten_parameters(network):
+    '''
+    Move all parameters of network into one contiguous tensor and turn the
+    parameters into views of it. The parameter objects stay the same, so
+    optimizers and state dicts are unaffected. Returns the flat tensor.
+    '''
+    parameters = list(network.parameters())
+    flat_parameters = torch.cat([p.data.reshape(-1) for p in parameters])
+    offset = 0
+    for p in parameters:
+        n = p.numel()
+        p.data = flat_parameters[offset:offset+n].view_as(p)
+        offset += n
+    return flat_parameters
+
+
 class agent_base():
 
     def __init__(self, parameters):
@@ -68,7 +1062,6 @@ class agent_base():
         self.parameters = copy.deepcopy(parameters)
         self.initialize_neural_networks(neural_networks= parameters['neural_networks'])
         self.initialize_optimizers(optimizers=parameters['optimizers'])
-        self.initialize_losses(losses=parameters['losses'])
         self.in_training = False
 
     def make_dictionary_keys_lowercase(self,dictionary):
@@ -100,7 +1093,7 @@ class agent_base():
                         'optimizer_args':{'lr':1e-3}, # learning rate is here
                     }
                 },
-            'losses':
+            'losses': # ignored, the loss is always the squared TD error of dqn_loss
                 {
                     'policy_net':{            
                         'loss':'MSELoss',
@@ -108,6 +1101,7 @@ class agent_base():
                 },
             'n_memory':20000,
             'training_stride':5,
+            'gradient_steps_per_update':1, # optimization steps every training_stride simulated steps
             'batch_size':32,
             'saving_stride':100,
             'n_episodes_max':10000,
@@ -115,6 +1109,23 @@ class agent_base():
             'solving_threshold_min':200,
             'solving_threshold_mean':230,
             'discount_factor':0.99,
+            'n_step':1, # number of steps summed into the returns of sampled transitions
+            'prefetch_batches':0, # minibatches sampled ahead in a background thread, 0 samples synchronously
+            'prioritized_replay':False,
+            'prioritized_replay_alpha':0.6,
+            'prioritized_replay_beta':0.4, # annealed to 1 during training
+            'prioritized_replay_beta_increment':1e-4, # increase of beta per sampled batch
+            'prioritized_replay_epsilon':1e-6,
+            'memory_path':None, # directory for an on-disk (memory-mapped) replay memory, reopened if it exists
+            'deduplicate_observations':False, # store each observation once in replay memory
+            'memory_dtype':'float32', # storage of observations and rewards: 'float32', 'float16' or 'bfloat16'
+            'checkpoint_keep_last':None, # retention policy for model snapshots,
+            'checkpoint_keep_best':None, # None keeps all snapshots
+            'asynchronous_checkpointing':True, # write snapshots in a background thread
+            'checkpoint_queue_depth':2, # maximal number of snapshots waiting to be written
+            'training_log_compression':None, # e.g. 'gzip' or 'lzf'
+            'training_log_swmr':False, # allow monitoring processes to read the training log while it is written
+            'profile_training':False, # record the time spent in each phase of the training loop
         }
         parameters = self.make_dictionary_keys_lowercase(parameters)
         
@@ -132,15 +1143,65 @@ class agent_base():
 
     def set_parameters(self,parameters):
         self.discount_factor = parameters['discount_factor']
+        self.n_step = int(parameters['n_step'])
+        self.prefetch_batches = int(parameters['prefetch_batches'])
+        self.memory_lock = threading.Lock() # guards memory against the prefetcher
+        self.prefetcher = None
         self.n_memory = int(parameters['n_memory'])
-        self.memory = memory(self.n_memory)
+        self.prioritized_replay = parameters['prioritized_replay']
+        self.memory_path = parameters['memory_path']
+        self.deduplicate_observations = parameters['deduplicate_observations']
+        self.memory_dtype = parameters['memory_dtype']
+        if self.memory_dtype not in storage_dtypes:
+            raise RuntimeError(f"Unknown memory_dtype {self.memory_dtype}, use one of {list(storage_dtypes)}.")
+        self.initialize_memory(parameters=parameters)
         self.training_stride = parameters['training_stride']
+        self.gradient_steps_per_update = int(parameters['gradient_steps_per_update'])
         self.batch_size = int(parameters['batch_size'])
         self.saving_stride = parameters['saving_stride']
         self.n_episodes_max = parameters['n_episodes_max']
         self.n_solving_episodes = parameters['n_solving_episodes']
         self.solving_threshold_min = parameters['solving_threshold_min']
         self.solving_threshold_mean = parameters['solving_threshold_mean']
+        self.checkpoint_keep_last = parameters['checkpoint_keep_last']
+        self.checkpoint_keep_best = parameters['checkpoint_keep_best']
+        self.asynchronous_checkpointing = parameters['asynchronous_checkpointing']
+        self.checkpoint_queue_depth = parameters['checkpoint_queue_depth']
+        self.training_log_compression = parameters['training_log_compression']
+        self.training_log_swmr = parameters['training_log_swmr']
+        self.profile_training = parameters['profile_training']
+        self.timer = phase_timer() if self.profile_training else null_timer()
+        
+    def initialize_memory(self,parameters):
+        if self.prioritized_replay:
+            if self.memory_path != None or self.deduplicate_observations:
+                raise RuntimeError("Prioritized replay is not supported with memory_path or deduplicate_observations.")
+            self.memory = prioritized_memory(capacity=self.n_memory,
+                    n_state=self.n_state,
+                    alpha=parameters['prioritized_replay_alpha'],
+                    beta=parameters['prioritized_replay_beta'],
+                    beta_increment=parameters['prioritized_replay_beta_increment'],
+                    epsilon=parameters['prioritized_replay_epsilon'],
+                    dtype=self.memory_dtype,
+                    n_step=self.n_step,
+                    discount_factor=self.discount_factor)
+        elif self.deduplicate_observations:
+            if self.memory_path != None:
+                raise RuntimeError("deduplicate_observations is not supported with memory_path.")
+            self.memory = deduplicated_memory(capacity=self.n_memory, n_state=self.n_state,
+                                              dtype=self.memory_dtype, n_step=self.n_step,
+                                              discount_factor=self.discount_factor)
+        elif self.memory_path != None:
+            # an existing memory in memory_path is reopened, not overwritten
+            mode = 'r+' if os.path.exists(os.path.join(self.memory_path, 'meta.json')) else 'w+'
+            self.memory = memmap_memory(capacity=self.n_memory, n_state=self.n_state,
+                                        directory=self.memory_path, mode=mode,
+                                        dtype=self.memory_dtype, n_step=self.n_step,
+                                        discount_factor=self.discount_factor)
+        else:
+            self.memory = memory(capacity=self.n_memory, n_state=self.n_state,
+                                 dtype=self.memory_dtype, n_step=self.n_step,
+                                 discount_factor=self.discount_factor)
         
     # def get_parameters(self):
     #     """Return dictionary with parameters of the current agent instance"""
@@ -159,27 +1220,23 @@ class agent_base():
                         self.neural_networks[key].parameters(),
                             **value['optimizer_args'])
     
-    def initialize_losses(self,losses):
-        self.losses = {}
-        for key, value in losses.items():
-            self.losses[key] = nn.MSELoss()
-
     def get_number_of_model_parameters(self,name='policy_net'): 
         return sum(p.numel() for p in self.neural_networks[name].parameters() if p.requires_grad)
 
 
     def get_state(self):
-        state = {'parameters':self.parameters}
+        state = {'parameters':copy.deepcopy(self.parameters)}
         for name,neural_network in self.neural_networks.items():
-            state[name] = copy.deepcopy(neural_network.state_dict())
+            state[name] = clone_state_dict(neural_network.state_dict())
         for name,optimizer in (self.optimizers).items():
-            state[name+'_optimizer'] = copy.deepcopy(optimizer.state_dict())
+            state[name+'_optimizer'] = clone_state_dict(optimizer.state_dict())
         return state
     
 
     def load_state(self,state):
         parameters=state['parameters']
         self.check_parameter_dictionary_compatibility(parameters=parameters)
+        self.memory.flush() # an on-disk memory is reopened by __init__
         self.__init__(parameters=parameters)
         for name,state_dict in (state).items():
             if name == 'parameters':
@@ -221,142 +1278,600 @@ class agent_base():
         return False, minimal_return, mean_return
 
     def add_memory(self,memory):
-        self.memory.push(*memory)
+        with self.memory_lock:
+            self.memory.push(*memory)
 
-    def get_samples_from_memory(self):
-        current_transitions = self.memory.sample(batch_size=self.batch_size)
-        batch = Transition(*zip(*current_transitions))
-        state_batch = torch.cat( [s.unsqueeze(0) for s in batch.state],dim=0)
-        next_state_batch = torch.cat(
-                         [s.unsqueeze(0) for s in batch.next_state],dim=0)
-        action_batch = torch.cat(batch.action)
-        reward_batch = torch.cat(batch.reward)
-        done_batch = torch.tensor(batch.done).float()
-        
-        return state_batch, action_batch, next_state_batch, reward_batch, done_batch
+    def add_memory_batch(self,memories):
+        with self.memory_lock:
+            self.memory.push_batch(*memories)
+
+    def get_samples_from_memory(self, n_batches=1):
+        if self.prefetcher != None and n_batches == self.prefetcher.n_minibatches:
+            return self.prefetcher.get()
+        return self.memory.sample(batch_size=self.batch_size, n_batches=n_batches)
+
+    def start_prefetching(self):
+        if self.prefetch_batches > 0 and self.prefetcher == None:
+            self.prefetcher = batch_prefetcher(memory=self.memory,
+                                               batch_size=self.batch_size,
+                                               lock=self.memory_lock,
+                                               n_batches=self.prefetch_batches,
+                                               n_minibatches=self.gradient_steps_per_update)
+
+    def stop_prefetching(self):
+        if self.prefetcher != None:
+            self.prefetcher.close()
+            self.prefetcher = None
         
     
-    def train(self,environment, verbose=True, model_filename=None, training_filename=None,):
+    def train(self,environment, verbose=True, model_filename=None, training_filename=None,
+              resume_filename=None, resume_from=None,):
         """
         Train the agent on a provided environment
 
         Keyword arguments:
         environment 
         verbose (Bool)
-        model_filename (string) -- Output filename for final trained model and
-                                   periodic snapshots of the model during 
-                                   training. Defaults to None, in which case
-                                   nothing is not written to disk
+        model_filename (string) -- Output directory for final trained model 
+                                   and periodic snapshots of the model during
+                                   training, see checkpoint_store. Defaults 
+                                   to None, in which case nothing is not 
+                                   written to disk
         training_filename (string) -- Output filename for training data, 
                                       namely lists of episode durations, 
                                       episode returns, number of training 
                                       epochs, and total number of steps 
-                                      simulated. Defaults to None, in which 
-                                      case no training data is written to disk
+                                      simulated, see training_log. Defaults
+                                      to None, in which case no training 
+                                      data is written to disk
+        resume_filename (string) -- Output directory for the full training
+                                    state (networks, optimizers, replay 
+                                    memory, counters, epsilon, random number
+                                    generators and training results), 
+                                    written every saving_stride episodes.
+                                    Defaults to None, in which case it is
+                                    not written.
+        resume_from (string) -- Directory written via resume_filename in an
+                                earlier, interrupted training. Training 
+                                continues exactly where it left off.
+
+        Batched environments that provide num_envs (e.g. gymnasium vector
+        environments) are trained with train_vectorized.
         """
-        self.in_training = True
-        training_complete = False
+        if is_vector_environment(environment):
+            if resume_filename != None or resume_from != None:
+                raise RuntimeError("Resuming training is only supported for single environments.")
+            return self.train_vectorized(environment=environment,
+                                         verbose=verbose,
+                                         model_filename=model_filename,
+                                         training_filename=training_filename)
+        
+        first_episode = 0
         step_counter = 0 # total number of simulated environment steps
         epoch_counter = 0 # number of training epochs 
         
-        # lists for documenting the training
-        episode_durations = [] # duration of each training episodes
-        episode_returns = [] # return of each training episode
-        steps_simulated = [] # total number of steps simulated at the end of
-                             # each training episode
-        training_epochs = [] # total number of training epochs at the end of 
-                             # each training episode
+        # lists for documenting the training, namely the duration and return
+        # of each training episode and the total number of training epochs
+        # and of steps simulated at the end of each training episode
+        training_results = self.get_empty_training_results()
+        
+        if resume_from != None:
+            first_episode, step_counter, epoch_counter, training_results = \
+                        self.load_training_state(directory=resume_from,
+                                                 environment=environment)
         
-        output_state_dicts = {} # dictionary in which we will save the status of the neural networks and optimizer every self.saving_stride steps epochs during training.  We also store the final neural network resulting from our training in this  dictionary
+        # a single environment pushes its trajectory to consecutive slots,
+        # also after pretraining with train_vectorized
+        self.memory.trajectory_stride = 1
+        self.in_training = True
+        self.timer.reset()
+        self.start_prefetching()
+        training_complete = False
+        
+        # store in which we will save the status of the neural networks and optimizer every self.saving_stride episodes during training.  We also store the final neural network resulting from our training in this store
+        checkpoints = self.get_checkpoint_store(model_filename=model_filename)
+        training_log = self.get_training_log(training_filename=training_filename)
         
         if verbose:
-            training_progress_header = (
-                "| episode | return          | minimal return    "
-                    "  | mean return        |\n"
-                "|         | (this episode)  | (last {0} episodes)  "
-                    "| (last {0} episodes) |\n"
-                "|---------------------------------------------------"
-                    "--------------------")
-            print(training_progress_header.format(self.n_solving_episodes))
-            
-            status_progress_string = ( 
-                        "| {0: 7d} |   {1: 10.3f}    |     "
-                        "{2: 10.3f}      |    {3: 10.3f}      |")
+            self.print_training_progress_header()
         
-        for n_episode in range(self.n_episodes_max):
+        for n_episode in range(first_episode, self.n_episodes_max):
             
             state, info = environment.reset()
             current_total_reward = 0.
             
             for i in itertools.count(): # timesteps of environment
                 
+                t = self.timer.now()
                 action = self.act(state=state)
+                t = self.timer.record('act', t)
                 next_state, reward, terminated, truncated, info = environment.step(action)
+                t = self.timer.record('env_step', t)
                 
                 step_counter += 1 # increase total steps simulated
                 done = terminated or truncated # did the episode end?
                 current_total_reward += reward 
                 
                 # store the transition in memory
-                reward = torch.tensor([np.float32(reward)], device=device)
-                action = torch.tensor([action], device=device)
-                self.add_memory([torch.tensor(state), action, torch.tensor(next_state), reward, done])
+                self.add_memory([state, action, next_state, reward, done])
+                self.timer.record('add_memory', t)
                 
                 state = next_state
                 
                 if step_counter % self.training_stride == 0:
                     # train model
-                    self.run_optimization_step(epoch=epoch_counter) # this will be defined inside DQN
-                    epoch_counter += 1 # increase count of optimization steps
+                    self.run_optimization_steps(epoch=epoch_counter,
+                                                n_steps=self.gradient_steps_per_update) # this will be defined inside DQN
+                    epoch_counter += self.gradient_steps_per_update # increase count of optimization steps
                 
                 if done: 
-                    episode_durations.append(i + 1)
-                    episode_returns.append(current_total_reward)
-                    steps_simulated.append(step_counter)
-                    training_epochs.append(epoch_counter)
-                    
-                    training_complete, min_ret, mean_ret = self.evaluate_stopping_criterion(list_of_returns=episode_returns)
-                    if verbose:
-                            if n_episode % 100 == 0 and n_episode > 0:
-                                end='\n'
-                            else:
-                                end='\r'
-                            if min_ret > self.solving_threshold_min:
-                                if mean_ret > self.solving_threshold_mean:
-                                    end='\n'
-                            
-                            print(status_progress_string.format(n_episode, current_total_reward, min_ret,mean_ret), end=end)
                     break
-            #
-            # Save model and training stats to disk
-            if (n_episode % self.saving_stride == 0) or training_complete or n_episode == self.n_episodes_max-1:
-                
-                if model_filename != None:
-                    output_state_dicts[n_episode] = self.get_state()
-                    torch.save(output_state_dicts, model_filename)
-                
-                training_results = {
-                                        'episode_durations':episode_durations,
-                                        'epsiode_returns':episode_returns,
-                                        'n_training_epochs':training_epochs,
-                                        'n_steps_simulated':steps_simulated,
-                                        'training_completed':False,
-                                    }
-                
-                if training_filename != None:
-                    self.save_dictionary(dictionary=training_results, filename=training_filename)
+            
+            training_complete = self.record_episode(
+                                    training_results=training_results,
+                                    n_episode=n_episode,
+                                    duration=i + 1,
+                                    episode_return=current_total_reward,
+                                    step_counter=step_counter,
+                                    epoch_counter=epoch_counter,
+                                    verbose=verbose,
+                                    checkpoints=checkpoints,
+                                    training_log=training_log)
+            
+            if resume_filename != None and n_episode % self.saving_stride == 0:
+                t = self.timer.now()
+                self.save_training_state(directory=resume_filename,
+                                         n_episode=n_episode,
+                                         step_counter=step_counter,
+                                         epoch_counter=epoch_counter,
+                                         training_results=training_results,
+                                         environment=environment)
+                self.timer.record('checkpointing', t)
             
             if training_complete:
-                training_results['training_completed'] = True
                 break
         
+        self.finish_training(training_complete=training_complete,
+                             training_results=training_results,
+                             checkpoints=checkpoints,
+                             training_log=training_log)
+        
+        return training_results
+
+    def train_vectorized(self,environment, verbose=True, model_filename=None, training_filename=None,):
+        """
+        Train the agent on a batched environment, such as a gymnasium
+        SyncVectorEnv/AsyncVectorEnv. Actions for all sub-environments are
+        computed in one forward pass and transitions are pushed in bulk. 
+        Every episode finished by any of the sub-environments counts towards
+        n_episodes_max, saving_stride and the stopping criterion.
+
+        The environment must provide num_envs and follow the gymnasium 0.29
+        autoreset convention: when a sub-environment finishes, step() already
+        returns the first observation of its next episode and the final
+        observation is passed in info['final_observation'].
+
+        Keyword arguments are the same as for train.
+        """
+        n_envs = environment.num_envs
+        if self.n_step > 1:
+            if isinstance(self.memory, deduplicated_memory):
+                raise RuntimeError("n_step > 1 is not supported for deduplicated observations on a batched environment.")
+            # each step pushes one block of n_envs transitions, so the next
+            # transition of a sub-environment is n_envs slots further
+            self.memory.trajectory_stride = n_envs
+        self.in_training = True
+        self.timer.reset()
+        self.start_prefetching()
+        training_complete = False
+        step_counter = 0 # total number of simulated environment steps
+        epoch_counter = 0 # number of training epochs 
+        n_episode = 0 # number of finished episodes
+        
+        training_results = self.get_empty_training_results()
+        checkpoints = self.get_checkpoint_store(model_filename=model_filename)
+        training_log = self.get_training_log(training_filename=training_filename)
+        
+        # returns and durations of the running episode of each sub-environment
+        current_total_rewards = np.zeros(n_envs)
+        current_durations = np.zeros(n_envs, dtype=np.int64)
+        
+        if verbose:
+            self.print_training_progress_header()
+        
+        states, info = environment.reset()
+        
+        while not training_complete and n_episode < self.n_episodes_max:
+            
+            t = self.timer.now()
+            actions = self.act_batch(states=states)
+            t = self.timer.record('act', t)
+            next_states, rewards, terminated, truncated, info = environment.step(actions)
+            t = self.timer.record('env_step', t)
+            
+            dones = np.logical_or(terminated, truncated)
+            current_total_rewards += rewards
+            current_durations += 1
+            
+            # sub-environments that finished have been reset already, their
+            # final observation is passed in the info dictionary
+            final_states = next_states
+            if dones.any():
+                final_states = np.array(next_states, copy=True)
+                for j in np.flatnonzero(info.get('_final_observation', dones)):
+                    final_states[j] = info['final_observation'][j]
+            self.add_memory_batch([states, actions, final_states, rewards, dones])
+            self.timer.record('add_memory', t)
+            
+            states = next_states
+            
+            # keep one update (of gradient_steps_per_update optimization 
+            # steps) per training_stride simulated steps
+            n_updates = ((step_counter + n_envs) // self.training_stride
+                         - step_counter // self.training_stride)
+            step_counter += n_envs
+            for _ in range(n_updates):
+                self.run_optimization_steps(epoch=epoch_counter,
+                                            n_steps=self.gradient_steps_per_update)
+                epoch_counter += self.gradient_steps_per_update
+            
+            for j in np.flatnonzero(dones):
+                training_complete = self.record_episode(
+                                    training_results=training_results,
+                                    n_episode=n_episode,
+                                    duration=int(current_durations[j]),
+                                    episode_return=float(current_total_rewards[j]),
+                                    step_counter=step_counter,
+                                    epoch_counter=epoch_counter,
+                                    verbose=verbose,
+                                    checkpoints=checkpoints,
+                                    training_log=training_log)
+                current_total_rewards[j] = 0.
+                current_durations[j] = 0
+                n_episode += 1
+                if training_complete or n_episode == self.n_episodes_max:
+                    break
+        
+        self.finish_training(training_complete=training_complete,
+                             training_results=training_results,
+                             checkpoints=checkpoints,
+                             training_log=training_log)
+        
+        return training_results
+
+    def train_actor_learner(self,environment_fn, n_actors=None, weight_sync_stride=100,
+                            chunk_size=64, verbose=True, model_filename=None,
+                            training_filename=None,):
+        """
+        Train the agent with environment stepping and gradient steps running
+        in separate processes. Each actor process owns one environment and a
+        copy of the policy net, runs environment.step and epsilon-greedy
+        action selection, and sends its transitions in chunks through a
+        shared-memory queue. This (learner) process stores the transitions in
+        memory, runs the optimization steps and publishes the policy net
+        weights to the actors every weight_sync_stride optimization steps.
+
+        Keyword arguments:
+        environment_fn (callable) -- Picklable function without arguments 
+                                     that returns a new environment, e.g. 
+                                     functools.partial(gym.make, 
+                                     'LunarLander-v2'). Actor processes are
+                                     started with the 'spawn' method.
+        n_actors (int) -- Number of actor processes. Defaults to the number 
+                          of cores minus one (for the learner).
+        weight_sync_stride (int) -- Number of optimization steps between 
+                                    weight updates of the actors
+        chunk_size (int) -- Maximal number of transitions per queue message
+        
+        The remaining keyword arguments are the same as for train.
+        """
+        if n_actors is None:
+            n_actors = max(1, (os.cpu_count() or 2) - 1)
+        
+        # every chunk is a contiguous piece of one actor's trajectory
+        self.memory.trajectory_stride = 1
+        self.in_training = True
+        self.timer.reset()
+        self.start_prefetching()
+        training_complete = False
+        step_counter = 0
+        epoch_counter = 0
+        n_episode = 0
+        
+        training_results = self.get_empty_training_results()
+        checkpoints = self.get_checkpoint_store(model_filename=model_filename)
+        training_log = self.get_training_log(training_filename=training_filename)
+        
+        # policy net weights and epsilon shared with the actor processes
+        context = torch.multiprocessing.get_context('spawn')
+        shared_policy_net = neural_network(
+                    self.parameters['neural_networks']['policy_net']['layers'])
+        shared_policy_net.load_state_dict(self.neural_networks['policy_net'].state_dict())
+        shared_policy_net.share_memory()
+        shared_state_dict = shared_policy_net.state_dict()
+        weights_lock = context.Lock()
+        weights_version = context.Value('l', 0)
+        shared_epsilon = context.Value('d', self.epsilon)
+        transition_queue = context.Queue(maxsize=8*n_actors)
+        stop_event = context.Event()
+        
+        actors = []
+        for actor_id in range(n_actors):
+            actor = context.Process(target=run_actor,
+                        kwargs={'environment_fn':environment_fn,
+                                'layers':self.parameters['neural_networks']['policy_net']['layers'],
+                                'n_actions':self.n_actions,
+                                'shared_state_dict':shared_state_dict,
+                                'weights_lock':weights_lock,
+                                'weights_version':weights_version,
+                                'epsilon':shared_epsilon,
+                                'transition_queue':transition_queue,
+                                'stop_event':stop_event,
+                                'chunk_size':chunk_size,
+                                'seed':np.random.randint(2**31)},
+                        daemon=True)
+            actor.start()
+            actors.append(actor)
+        
+        if verbose:
+            self.print_training_progress_header()
+        
+        try:
+            while not training_complete and n_episode < self.n_episodes_max:
+                
+                while True: # wait for the next chunk, but not for actors that died
+                    try:
+                        chunk = transition_queue.get(timeout=1.)
+                        break
+                    except queue.Empty:
+                        exitcodes = [actor.exitcode for actor in actors]
+                        if any(exitcode not in [None, 0] for exitcode in exitcodes):
+                            raise RuntimeError(f"Actor process failed with exit codes {exitcodes}.")
+                        if all(exitcode is not None for exitcode in exitcodes):
+                            raise RuntimeError("All actor processes exited before training was complete.")
+                states, actions, next_states, rewards, dones, episodes = chunk
+                n_transitions = len(actions)
+                t = self.timer.now()
+                memories = [states.numpy(), actions.numpy(), next_states.numpy(),
+                            rewards.numpy(), dones.numpy()]
+                t = self.timer.record('tensor_conversion', t)
+                self.add_memory_batch(memories)
+                self.timer.record('add_memory', t)
+                
+                n_updates = ((step_counter + n_transitions) // self.training_stride
+                             - step_counter // self.training_stride)
+                step_counter += n_transitions
+                for _ in range(n_updates):
+                    self.run_optimization_steps(epoch=epoch_counter,
+                                                n_steps=self.gradient_steps_per_update)
+                    epoch_counter += self.gradient_steps_per_update
+                    if epoch_counter % weight_sync_stride < self.gradient_steps_per_update:
+                        with weights_lock:
+                            shared_policy_net.load_state_dict(
+                                    self.neural_networks['policy_net'].state_dict())
+                            weights_version.value += 1
+                shared_epsilon.value = self.epsilon
+                
+                for duration, episode_return in episodes:
+                    training_complete = self.record_episode(
+                                    training_results=training_results,
+                                    n_episode=n_episode,
+                                    duration=duration,
+                                    episode_return=episode_return,
+                                    step_counter=step_counter,
+                                    epoch_counter=epoch_counter,
+                                    verbose=verbose,
+                                    checkpoints=checkpoints,
+                                    training_log=training_log)
+                    n_episode += 1
+                    if training_complete or n_episode == self.n_episodes_max:
+                        break
+        finally:
+            stop_event.set()
+            # drain the queue so that actors blocked on put can exit; chunks of
+            # actors that exited already can no longer be received
+            while any(actor.is_alive() for actor in actors):
+                try:
+                    transition_queue.get(timeout=0.1)
+                except (queue.Empty, OSError, EOFError):
+                    pass
+            for actor in actors:
+                actor.join()
+        
+        self.finish_training(training_complete=training_complete,
+                             training_results=training_results,
+                             checkpoints=checkpoints,
+                             training_log=training_log)
+        
+        return training_results
+
+    def save_training_state(self, directory, n_episode, step_counter, epoch_counter,
+                            training_results, environment):
+        '''
+        Write everything needed to resume training after episode n_episode
+        to a new subdirectory of directory: replay.npz with the raw replay 
+        memory arrays and training_state.pt with the rest. The file 'latest'
+        is then switched atomically to the new subdirectory and older ones
+        are removed. An on-disk memory (memory_path) is flushed and only 
+        referenced by its directory, position and size instead of being 
+        copied; transitions pushed after the checkpoint remain in its files.
+        '''
+        name = f'episode_{n_episode:07d}'
+        path = os.path.join(directory, name)
+        os.makedirs(path, exist_ok=True)
+        if isinstance(self.memory, memmap_memory):
+            self.memory.flush()
+            memmap_state = {'directory':os.path.abspath(self.memory.directory),
+                            'position':self.memory.position,
+                            'size':self.memory.size}
+        else:
+            memmap_state = None
+            np.savez(os.path.join(path, 'replay.npz'), **self.memory.state_dict())
+        training_state = {'agent':self.get_state(),
+                          'memmap_memory':memmap_state,
+                          'n_episode':n_episode,
+                          'step_counter':step_counter,
+                          'epoch_counter':epoch_counter,
+                          'epsilon':getattr(self, 'epsilon', None),
+                          'training_results':copy.deepcopy(training_results),
+                          'torch_rng_state':torch.get_rng_state(),
+                          'numpy_rng_state':np.random.get_state(),
+                          'python_rng_state':random.getstate(),
+                          'environment_rng_state':environment.np_random.bit_generator.state}
+        torch.save(training_state, os.path.join(path, 'training_state.pt'))
+        with open(os.path.join(directory, 'latest.tmp'), 'w') as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(os.path.join(directory, 'latest.tmp'), os.path.join(directory, 'latest'))
+        for old_name in os.listdir(directory):
+            if old_name.startswith('episode_') and old_name != name:
+                shutil.rmtree(os.path.join(directory, old_name), ignore_errors=True)
+
+    def load_training_state(self, directory, environment):
+        '''
+        Restore the training state written by save_training_state and return
+        (first episode to run, step_counter, epoch_counter, training_results)
+        '''
+        with open(os.path.join(directory, 'latest'), 'r') as f:
+            path = os.path.join(directory, f.read().strip())
+        training_state = torch.load(os.path.join(path, 'training_state.pt'), weights_only=False)
+        self.load_state(training_state['agent']) # re-initializes the agent
+        memmap_state = training_state['memmap_memory']
+        if memmap_state is not None: # load_state reopened the on-disk memory
+            if os.path.abspath(self.memory.directory) != memmap_state['directory']:
+                raise RuntimeError(f"Training state refers to the replay memory in {memmap_state['directory']}, "
+                                   f"but the agent uses {self.memory.directory}.")
+            self.memory.position = memmap_state['position']
+            self.memory.size = memmap_state['size']
+            self.memory.flush()
+        else:
+            with np.load(os.path.join(path, 'replay.npz')) as replay:
+                self.memory.load_state_dict(dict(replay))
+        if training_state['epsilon'] is not None:
+            self.epsilon = training_state['epsilon']
+        torch.set_rng_state(training_state['torch_rng_state'])
+        np.random.set_state(training_state['numpy_rng_state'])
+        random.setstate(training_state['python_rng_state'])
+        environment.np_random = np.random.Generator(np.random.PCG64())
+        environment.np_random.bit_generator.state = training_state['environment_rng_state']
+        return (training_state['n_episode'] + 1, training_state['step_counter'],
+                training_state['epoch_counter'], training_state['training_results'])
+
+    def get_empty_training_results(self):
+        return {
+                    'episode_durations':[],
+                    'epsiode_returns':[],
+                    'n_training_epochs':[],
+                    'n_steps_simulated':[],
+                    'training_completed':False,
+                }
+
+    def record_episode(self, training_results, n_episode, duration, episode_return,
+                       step_counter, epoch_counter, verbose, checkpoints,
+                       training_log):
+        """
+        Document a finished training episode, print the training progress and 
+        save model and training stats to disk every saving_stride episodes.
+        Returns True if the stopping criterion is met.
+        """
+        training_results['episode_durations'].append(duration)
+        training_results['epsiode_returns'].append(episode_return)
+        training_results['n_training_epochs'].append(epoch_counter)
+        training_results['n_steps_simulated'].append(step_counter)
+        
+        training_complete, min_ret, mean_ret = self.evaluate_stopping_criterion(
+                        list_of_returns=training_results['epsiode_returns'])
+        if verbose:
+            self.print_training_progress(n_episode, episode_return, min_ret, mean_ret)
+        
+        if verbose and self.profile_training and n_episode % 100 == 0 and n_episode > 0:
+            print(self.timer.format_summary())
+        
+        if (n_episode % self.saving_stride == 0) or training_complete or n_episode == self.n_episodes_max-1:
+            t = self.timer.now()
+            self.memory.flush()
+            if len(training_results['epsiode_returns']) < self.n_solving_episodes:
+                # the 0. placeholders of evaluate_stopping_criterion must not
+                # rank an early snapshot above trained ones
+                min_ret, mean_ret = None, None
+            self.save_training_progress(n_episode=n_episode,
+                                        training_results=training_results,
+                                        min_return=min_ret,
+                                        mean_return=mean_ret,
+                                        checkpoints=checkpoints,
+                                        training_log=training_log)
+            self.timer.record('checkpointing', t)
+        
+        if training_complete:
+            training_results['training_completed'] = True
+        return training_complete
+
+    def finish_training(self, training_complete, training_results, checkpoints, training_log):
+        self.stop_prefetching()
+        if self.profile_training:
+            training_results['timing'] = self.timer.get_summary()
+        self.memory.flush()
+        if checkpoints != None:
+            checkpoints.close() # wait for snapshots still being written
+        if training_log != None:
+            training_log.append(training_results=training_results)
+            training_log.close()
         if not training_complete:
             warning_string = f"Warning: Training is stopped because the maximum number of episodes, {self.n_episodes_max}. But the stopping criterion has not been met."
             warnings.warn(warning_string)
         
         self.in_training = False
+
+    def print_training_progress_header(self):
+        training_progress_header = (
+            "| episode | return          | minimal return    "
+                "  | mean return        |\n"
+            "|         | (this episode)  | (last {0} episodes)  "
+                "| (last {0} episodes) |\n"
+            "|---------------------------------------------------"
+                "--------------------")
+        print(training_progress_header.format(self.n_solving_episodes))
+
+    def print_training_progress(self, n_episode, current_total_reward, min_ret, mean_ret):
+        status_progress_string = ( 
+                    "| {0: 7d} |   {1: 10.3f}    |     "
+                    "{2: 10.3f}      |    {3: 10.3f}      |")
+        if n_episode % 100 == 0 and n_episode > 0:
+            end='\n'
+        else:
+            end='\r'
+        if min_ret > self.solving_threshold_min:
+            if mean_ret > self.solving_threshold_mean:
+                end='\n'
         
-        return training_results
+        print(status_progress_string.format(n_episode, current_total_reward, min_ret,mean_ret), end=end)
+
+    def get_checkpoint_store(self, model_filename):
+        if model_filename == None:
+            return None
+        return checkpoint_store(directory=model_filename,
+                                keep_last=self.checkpoint_keep_last,
+                                keep_best=self.checkpoint_keep_best,
+                                asynchronous=self.asynchronous_checkpointing,
+                                queue_depth=self.checkpoint_queue_depth)
+
+    def get_training_log(self, training_filename):
+        if training_filename == None:
+            return None
+        return training_log(filename=training_filename,
+                            compression=self.training_log_compression,
+                            swmr=self.training_log_swmr)
+
+    def save_training_progress(self, n_episode, training_results, min_return,
+                               mean_return, checkpoints, training_log):
+        """Save model and training stats to disk"""
+        if checkpoints != None:
+            checkpoints.save(n_episode=n_episode, state=self.get_state(),
+                             min_return=min_return, mean_return=mean_return)
+        
+        if training_log != None:
+            training_log.append(training_results=training_results)
 
     def save_dictionary(self,dictionary,filename):
         with h5py.File(filename, 'w') as hf:
@@ -380,7 +1895,7 @@ class agent_base():
         return_dict = {}
         for key, value in h5file[path].items():
             if isinstance(value, h5py._hl.dataset.Dataset):
-                return_dict[key] = value.value
+                return_dict[key] = value[()]
             elif isinstance(value, h5py._hl.group.Group):
                 return_dict[key] = self.load_dictionary_recursively(\
                                             h5file=h5file, 
@@ -392,6 +1907,10 @@ class dqn(agent_base):
     def __init__(self,parameters):
         super().__init__(parameters=parameters)
         self.in_training = False
+        # input buffer for action selection, grown to the largest batch seen
+        self.act_input_buffer = torch.empty((1, self.n_state), dtype=torch.float32)
+        self.initialize_target_net_update()
+        self.initialize_compilation() # after flattening the parameters
 
     def get_default_parameters(self):
         '''
@@ -408,6 +1927,8 @@ class dqn(agent_base):
         default_parameters['epsilon_1'] = 0.1 # final value for epsilon
         default_parameters['d_epsilon'] = 0.00005 # decrease of epsilon
         default_parameters['doubledqn'] = False
+        default_parameters['target_net_update_mode'] = 'foreach' # 'foreach' or 'flat'
+        default_parameters['compile_mode'] = None # None, 'script' (TorchScript) or 'compile' (torch.compile)
         return default_parameters
 
 
@@ -417,6 +1938,8 @@ class dqn(agent_base):
             self.doubleDQN = parameters['doubledqn']
             self.target_net_update_stride = parameters['target_net_update_stride']
             self.target_net_update_tau = parameters['target_net_update_tau']
+            self.target_net_update_mode = parameters['target_net_update_mode']
+            self.compile_mode = parameters['compile_mode']
             # check if provided parameter is within bounds
             error_msg = f"Parameter 'target_net_update_tau' has to be between 0 and 1, but value {self.target_net_update_tau} has been passed."
             if self.target_net_update_tau < 0:
@@ -445,45 +1968,97 @@ class dqn(agent_base):
         if self.in_training:
             epsilon = self.epsilon
 
-        if torch.rand(1).item() > epsilon: 
-            policy_net = self.neural_networks['policy_net']
-            
-            with torch.no_grad():
-                policy_net.eval()
-                action = policy_net(torch.tensor(state)).argmax(0).item()
-                policy_net.train()
-                return action
+        if np.random.rand() > epsilon: 
+            return int(self.get_greedy_actions(states=state[None])[0])
         else:
-            return torch.randint(low=0,high=self.n_actions,size=(1,)).item()
+            return np.random.randint(self.n_actions)
+        
+    def act_batch(self, states, epsilon=0.0):
+        """Return epsilon-greedy actions for a batch of states (N, n_state)"""
+        if self.in_training:
+            epsilon = self.epsilon
+        
+        n = len(states)
+        explore = np.random.rand(n) < epsilon
+        if explore.all(): # no need for a forward pass
+            return np.random.randint(0, self.n_actions, size=n)
+        actions = self.get_greedy_actions(states=states)
+        if explore.any():
+            actions[explore] = np.random.randint(0, self.n_actions, size=explore.sum())
+        return actions
+
+    def get_greedy_actions(self, states):
+        n = len(states)
+        if n > len(self.act_input_buffer):
+            self.act_input_buffer = torch.empty((n, self.n_state), dtype=torch.float32)
+        # copy (and cast) the states into the reusable input buffer, which
+        # shares its memory with the NumPy view
+        input_buffer = self.act_input_buffer[:n]
+        input_buffer.numpy()[:] = states
+        
+        policy_net = self.neural_networks['policy_net']
+        if policy_net.training: # run_optimization_step turns training mode back on
+            policy_net.eval()
+        with self.act_grad_mode():
+            return self.act_forward(input_buffer).argmax(1).numpy()
         
     def update_epsilon(self):
         self.epsilon = max(self.epsilon - self.d_epsilon, self.epsilon_1)
 
-    def run_optimization_step(self,epoch):
+    def run_optimization_steps(self, epoch, n_steps):
+        '''
+        Run n_steps optimization steps on minibatches that are sampled from
+        memory together, with a single gather and tensor conversion
+        '''
+        if n_steps == 1:
+            return self.run_optimization_step(epoch=epoch)
+        if len(self.memory) < self.batch_size:
+            return
+        
+        t = self.timer.now()
+        batch = self.get_samples_from_memory(n_batches=n_steps)
+        self.timer.record('get_samples_from_memory', t)
+        for k, minibatch in enumerate(split_batch(batch, n_steps)):
+            self.run_optimization_step(epoch=epoch + k, batch=minibatch)
+
+    def run_optimization_step(self, epoch, batch=None):
         if len(self.memory) < self.batch_size:
             return
         
-        state_batch, action_batch, next_state_batch, reward_batch, done_batch = self.get_samples_from_memory()
+        t = self.timer.now()
+        if batch is None:
+            batch = self.get_samples_from_memory()
+            t = self.timer.record('get_samples_from_memory', t)
+        state_batch = batch.state.to(device)
+        action_batch = batch.action.to(device)
+        next_state_batch = batch.next_state.to(device)
+        reward_batch = batch.reward.to(device)
+        done_batch = batch.done.to(device)
+        discount = self.discount_tensor if batch.discount is None else batch.discount.to(device)
+        # prioritized replay: weight each squared TD error with its
+        # importance-sampling weight
+        weights = None if batch.weights is None else batch.weights.to(device)
+        t = self.timer.record('tensor_conversion', t)
         
         policy_net = self.neural_networks['policy_net']
-        target_net = self.neural_networks['target_net']
         optimizer = self.optimizers['policy_net']
-        loss = self.losses['policy_net']
         policy_net.train() # turn on training mode
-        LHS = policy_net(state_batch.to(device)).gather(dim=1, index=action_batch.unsqueeze(1))
-        if self.doubleDQN:
-            argmax_next_state = policy_net(next_state_batch).argmax(dim=1)
-            Q_next_state = target_net(next_state_batch).gather(dim=1,index=argmax_next_state.unsqueeze(1)).squeeze(1)
-        else:
-            Q_next_state = target_net(next_state_batch).max(1)[0].detach()
-            # Q_next_state.shape = [batch_size]
-        RHS = Q_next_state * self.discount_factor * (1.-done_batch) + reward_batch
-        RHS = RHS.unsqueeze(1) # RHS.shape = [batch_size, 1]
-       
-        loss_ = loss(LHS, RHS)
+        loss_, LHS, RHS = self.compute_loss(state_batch, action_batch, next_state_batch,
+                                            reward_batch, done_batch, discount, weights)
+        # LHS.shape = RHS.shape = [batch_size, 1]
+        t = self.timer.record('forward', t)
         optimizer.zero_grad()
         loss_.backward()
+        t = self.timer.record('backward', t)
         optimizer.step()
+        t = self.timer.record('optimizer_step', t)
+        
+        if batch.weights is not None:
+            # use the TD errors as new priorities
+            td_errors = (RHS - LHS).detach().squeeze(1).cpu().numpy()
+            with self.memory_lock:
+                self.memory.update_priorities(indices=batch.indices, td_errors=td_errors)
+            t = self.timer.record('update_priorities', t)
         
         policy_net.eval() # turn off training mode
         
@@ -491,20 +2066,341 @@ class dqn(agent_base):
         
         if epoch % self.target_net_update_stride == 0:
             self.soft_update_target_net() # soft update target net
+            self.timer.record('target_net_update', t)
         
         
+    def compute_loss(self, state, action, next_state, reward, done, discount, weights):
+        q_values = self.policy_forward(state)
+        with torch.no_grad():
+            next_q_target = self.target_forward(next_state)
+            next_q_policy = self.policy_forward(next_state) if self.doubleDQN else None
+        return self.loss_function(q_values, action, next_q_target, next_q_policy,
+                                  reward, done, discount, weights)
+
+    def initialize_compilation(self):
+        """
+        Set the forward passes and the loss used by act and 
+        run_optimization_step. With compile_mode 'script', policy and target
+        net and dqn_loss are compiled with TorchScript; with 'compile', 
+        compute_loss (forward passes and loss) and the forward pass of act 
+        are compiled with torch.compile. The compiled networks share their
+        parameters with the eager ones. If compilation is unavailable, a 
+        warning is issued and eager PyTorch is used.
+        """
+        policy_net = self.neural_networks['policy_net']
+        target_net = self.neural_networks['target_net']
+        self.discount_tensor = torch.tensor(self.discount_factor, dtype=torch.float32, device=device)
+        self.policy_forward = policy_net
+        self.target_forward = target_net
+        self.act_forward = policy_net
+        self.act_grad_mode = torch.inference_mode
+        self.loss_function = dqn_loss
+        if self.compile_mode not in [None, 'script', 'compile']:
+            raise RuntimeError("Parameter 'compile_mode' has to be None, 'script' or 'compile', "
+                               f"but value {self.compile_mode} has been passed.")
+        try:
+            if self.compile_mode == 'script':
+                with warnings.catch_warnings(): # TorchScript is deprecated in recent PyTorch
+                    warnings.simplefilter('ignore', FutureWarning)
+                    self.policy_forward = torch.jit.script(policy_net)
+                    self.target_forward = torch.jit.script(target_net)
+                    self.loss_function = torch.jit.script(dqn_loss)
+                self.act_forward = self.policy_forward
+                # the TorchScript executor records autograd state, which 
+                # inference tensors do not support
+                self.act_grad_mode = torch.no_grad
+            elif self.compile_mode == 'compile':
+                # torch.compile compiles lazily, errors show up at the first call
+                self.compute_loss = eager_fallback(compiled=torch.compile(self.compute_loss),
+                                                   eager=self.compute_loss, name='loss')
+                self.act_forward = eager_fallback(compiled=torch.compile(policy_net),
+                                                  eager=policy_net, name='policy net')
+        except Exception as error:
+            warnings.warn(f"Compilation with compile_mode '{self.compile_mode}' is not available "
+                          f"({type(error).__name__}: {error}), using eager PyTorch.")
+            self.policy_forward = policy_net
+            self.target_forward = target_net
+            self.act_forward = policy_net
+            self.act_grad_mode = torch.inference_mode
+            self.loss_function = dqn_loss
+
+    def initialize_target_net_update(self):
+        """
+        Prepare the parameter lists for the fused soft update of the target
+        net. In 'flat' mode the parameters of policy and target net are first
+        moved into one contiguous buffer per network (the parameters become
+        views into that buffer), so that a single lerp_ updates the whole
+        target net.
+        """
+        policy_net = self.neural_networks['policy_net']
+        target_net = self.neural_networks['target_net']
+        if self.target_net_update_mode == 'flat':
+            self.policy_net_flat_parameters = flatten_parameters(policy_net)
+            self.target_net_flat_parameters = flatten_parameters(target_net)
+        elif self.target_net_update_mode != 'foreach':
+            raise RuntimeError("Parameter 'target_net_update_mode' has to be 'foreach' "
+                        f"or 'flat', but value {self.target_net_update_mode} has been passed.")
+        self.policy_net_parameters = list(policy_net.parameters())
+        self.target_net_parameters = list(target_net.parameters())
+
     def soft_update_target_net(self):
-        # this code is from https://stackoverflow.com/q/48560227
-        params1 = self.neural_networks['policy_net'].named_parameters()
-        params2 = self.neural_networks['target_net'].named_parameters()
+        # target = target + tau*(policy - target), computed in place without
+        # temporaries
+        with torch.no_grad():
+            if self.target_net_update_mode == 'flat':
+                self.target_net_flat_parameters.lerp_(self.policy_net_flat_parameters,
+                                                      self.target_net_update_tau)
+            else:
+                torch._foreach_lerp_(self.target_net_parameters,
+                                     self.policy_net_parameters,
+                                     self.target_net_update_tau)
+
 
-        dict_params2 = dict(params2)
 
-        for name1, param1 in params1:
-            if name1 in dict_params2:
-                dict_params2[name1].data.copy_(\
-                    self.target_net_update_tau*param1.data\
-                + (1-self.target_net_update_tau)*dict_params2[name1].data)
-        self.neural_networks['target_net'].load_state_dict(dict_params2)
+class dqn_ensemble():
+    '''
+    Ensemble of n_agents independent dqn agents (e.g. different seeds) 
+    trained in lockstep in one process. The policy and target nets of all 
+    agents are stacked with torch.func.stack_module_state and evaluated with
+    torch.func.vmap, so forward pass, backward pass, optimizer step and 
+    target net update run once for all agents. Replay memories, epsilon
+    schedules, training results and stopping criteria stay per agent (in
+    self.agents). All agents share the same parameters.
+    '''
+
+    def __init__(self, parameters, n_agents=8, seeds=None):
+        if seeds is None:
+            seeds = list(range(n_agents))
+        self.seeds = seeds
+        self.n_agents = len(seeds)
+        self.agents = []
+        for i, seed in enumerate(seeds): # different initial weights for each agent
+            torch.manual_seed(seed)
+            agent_parameters = parameters
+            if parameters.get('memory_path') != None: # one on-disk memory per agent
+                agent_parameters = dict(parameters, memory_path=os.path.join(
+                                            parameters['memory_path'], f'agent_{i}'))
+            self.agents.append(dqn(parameters=agent_parameters))
+        self.parameters = self.agents[0].parameters
+        reference_agent = self.agents[0]
+        self.n_state = reference_agent.n_state
+        self.n_actions = reference_agent.n_actions
+        self.batch_size = reference_agent.batch_size
+        self.training_stride = reference_agent.training_stride
+        self.gradient_steps_per_update = reference_agent.gradient_steps_per_update
+        self.discount_factor = reference_agent.discount_factor
+        self.doubleDQN = reference_agent.doubleDQN
+        self.target_net_update_stride = reference_agent.target_net_update_stride
+        self.target_net_update_tau = reference_agent.target_net_update_tau
+        self.n_episodes_max = reference_agent.n_episodes_max
+        
+        self.stacked_parameters = {}
+        self.stacked_buffers = {}
+        for name in ['policy_net', 'target_net']:
+            networks = [agent.neural_networks[name] for agent in self.agents]
+            self.stacked_parameters[name], self.stacked_buffers[name] = \
+                            torch.func.stack_module_state(networks)
+        for parameter in self.stacked_parameters['target_net'].values():
+            parameter.requires_grad_(False)
+        
+        # stateless copy of the network, evaluated with the stacked parameters
+        base_network = copy.deepcopy(reference_agent.neural_networks['policy_net']).to('meta')
+        def call_network(parameters, buffers, x):
+            return torch.func.functional_call(base_network, (parameters, buffers), (x,))
+        self.call_networks = torch.func.vmap(call_network)
+        
+        self.optimizer = torch.optim.RMSprop(
+                        list(self.stacked_parameters['policy_net'].values()),
+                        **self.parameters['optimizers']['policy_net']['optimizer_args'])
+
+    def forward(self, name, x):
+        '''Evaluate network name of every agent on x[i], x.shape = [n_agents, batch, n_state]'''
+        return self.call_networks(self.stacked_parameters[name],
+                                  self.stacked_buffers[name], x)
 
+    def act_batch(self, states):
+        '''Return an epsilon-greedy action for each agent, states.shape = [n_agents, n_state]'''
+        with torch.inference_mode():
+            q = self.forward('policy_net', torch.as_tensor(states, dtype=torch.float32).unsqueeze(1))
+        actions = q.squeeze(1).argmax(1).numpy()
+        epsilons = np.array([agent.epsilon for agent in self.agents])
+        explore = np.random.rand(self.n_agents) < epsilons
+        actions[explore] = np.random.randint(0, self.n_actions, size=explore.sum())
+        return actions
+
+    def get_ready_agents(self, active):
+        # agents that have finished training or have too few transitions in
+        # memory get zero loss, which leaves their parameters unchanged
+        return np.array([active[i] and len(agent.memory) >= self.batch_size
+                         for i, agent in enumerate(self.agents)])
+
+    def run_optimization_steps(self, epoch, active, n_steps):
+        '''
+        Run n_steps optimization steps; each agent samples its n_steps 
+        minibatches from memory together, as in dqn.run_optimization_steps
+        '''
+        if n_steps == 1:
+            return self.run_optimization_step(epoch=epoch, active=active)
+        ready = self.get_ready_agents(active=active)
+        if not ready.any():
+            return
+        
+        minibatches = [split_batch(agent.get_samples_from_memory(n_batches=n_steps), n_steps)
+                       if ready[i] else [None]*n_steps
+                       for i, agent in enumerate(self.agents)]
+        for k in range(n_steps):
+            self.run_optimization_step(epoch=epoch + k, active=active,
+                                       batches=[agent_minibatches[k] for agent_minibatches in minibatches])
+
+    def run_optimization_step(self, epoch, active, batches=None):
+        if batches is None:
+            ready = self.get_ready_agents(active=active)
+            if not ready.any():
+                return
+            batches = [agent.get_samples_from_memory() if ready[i] else None
+                       for i, agent in enumerate(self.agents)]
+        else:
+            ready = np.array([batch is not None for batch in batches])
+        reference = batches[int(np.flatnonzero(ready)[0])]
+        def stack(field):
+            return torch.stack([getattr(batch if batch is not None else reference, field)
+                                for batch in batches]).to(device)
+        state_batch = stack('state')
+        action_batch = stack('action')
+        next_state_batch = stack('next_state')
+        reward_batch = stack('reward')
+        done_batch = stack('done')
+        weights = torch.stack([batch.weights if batch is not None and batch.weights is not None
+                               else torch.ones(self.batch_size) for batch in batches]).to(device)
+        discount = self.discount_factor if reference.discount is None else stack('discount')
+        
+        LHS = self.forward('policy_net', state_batch).gather(dim=2, index=action_batch.unsqueeze(2)).squeeze(2)
+        with torch.no_grad():
+            if self.doubleDQN:
+                argmax_next_state = self.forward('policy_net', next_state_batch).argmax(dim=2)
+                Q_next_state = self.forward('target_net', next_state_batch).gather(
+                                    dim=2, index=argmax_next_state.unsqueeze(2)).squeeze(2)
+            else:
+                Q_next_state = self.forward('target_net', next_state_batch).max(2)[0]
+            RHS = Q_next_state * discount * (1.-done_batch) + reward_batch
+        
+        # sum of the per-agent losses, so that every agent gets the gradient
+        # of its own loss
+        loss_per_agent = (weights * (LHS - RHS)**2).mean(dim=1)
+        mask = torch.from_numpy(ready.astype(np.float32))
+        loss_ = (mask * loss_per_agent).sum()
+        self.optimizer.zero_grad()
+        loss_.backward()
+        self.optimizer.step()
+        
+        td_errors = (RHS - LHS).detach().cpu().numpy()
+        for i in np.flatnonzero(ready):
+            agent = self.agents[i]
+            if batches[i].weights is not None:
+                with agent.memory_lock: # the prefetcher samples concurrently
+                    agent.memory.update_priorities(indices=batches[i].indices, td_errors=td_errors[i])
+            agent.update_epsilon()
+        
+        if epoch % self.target_net_update_stride == 0:
+            self.soft_update_target_net(mask=mask)
+
+    def soft_update_target_net(self, mask):
+        with torch.no_grad():
+            for name, target_parameter in self.stacked_parameters['target_net'].items():
+                policy_parameter = self.stacked_parameters['policy_net'][name]
+                weight = (self.target_net_update_tau*mask).reshape(
+                                (-1,) + (1,)*(target_parameter.dim() - 1))
+                target_parameter.lerp_(policy_parameter, weight)
+
+    def copy_parameters_to_agents(self):
+        '''Write the stacked parameters back into the networks of the agents'''
+        with torch.no_grad():
+            for name in ['policy_net', 'target_net']:
+                for i, agent in enumerate(self.agents):
+                    for parameter_name, parameter in agent.neural_networks[name].named_parameters():
+                        parameter.copy_(self.stacked_parameters[name][parameter_name][i])
+
+    def train(self, environments, verbose=True):
+        """
+        Train all agents, agent i on environments[i], until each agent has
+        met its stopping criterion or has run n_episodes_max episodes.
+        Returns a list with the training results of each agent.
+        """
+        if len(environments) != self.n_agents:
+            raise RuntimeError(f"dqn_ensemble.train needs one environment per agent, "
+                               f"but {len(environments)} environments for {self.n_agents} agents have been passed.")
+        for agent in self.agents:
+            agent.in_training = True
+            agent.start_prefetching()
+        step_counter = 0
+        epoch_counter = 0
+        
+        training_results = [agent.get_empty_training_results() for agent in self.agents]
+        active = np.ones(self.n_agents, dtype=bool)
+        n_episodes = np.zeros(self.n_agents, dtype=np.int64)
+        current_total_rewards = np.zeros(self.n_agents)
+        current_durations = np.zeros(self.n_agents, dtype=np.int64)
+        
+        states = np.zeros((self.n_agents, self.n_state), dtype=np.float32)
+        for i, environment in enumerate(environments):
+            states[i], info = environment.reset()
+        
+        while active.any():
+            actions = self.act_batch(states=states)
+            step_counter += 1
+            
+            for i in np.flatnonzero(active):
+                agent = self.agents[i]
+                next_state, reward, terminated, truncated, info = environments[i].step(actions[i])
+                done = terminated or truncated
+                agent.add_memory([states[i], actions[i], next_state, reward, done])
+                current_total_rewards[i] += reward
+                current_durations[i] += 1
+                states[i] = next_state
+                
+                if done:
+                    training_complete = agent.record_episode(
+                                    training_results=training_results[i],
+                                    n_episode=n_episodes[i],
+                                    duration=int(current_durations[i]),
+                                    episode_return=float(current_total_rewards[i]),
+                                    step_counter=step_counter,
+                                    epoch_counter=epoch_counter,
+                                    verbose=False,
+                                    checkpoints=None,
+                                    training_log=None)
+                    n_episodes[i] += 1
+                    current_total_rewards[i] = 0.
+                    current_durations[i] = 0
+                    states[i], info = environments[i].reset()
+                    if training_complete or n_episodes[i] == self.n_episodes_max:
+                        active[i] = False
+                    if verbose and n_episodes.sum() % 100 == 0:
+                        self.print_training_progress(training_results=training_results,
+                                                     n_episodes=n_episodes, active=active)
+            
+            if step_counter % self.training_stride == 0:
+                self.run_optimization_steps(epoch=epoch_counter, active=active,
+                                            n_steps=self.gradient_steps_per_update)
+                epoch_counter += self.gradient_steps_per_update
+        
+        self.copy_parameters_to_agents()
+        for i, agent in enumerate(self.agents):
+            agent.finish_training(training_complete=training_results[i]['training_completed'],
+                                  training_results=training_results[i],
+                                  checkpoints=None, training_log=None)
+        if verbose:
+            self.print_training_progress(training_results=training_results,
+                                         n_episodes=n_episodes, active=active)
+        
+        return training_results
 
+    def print_training_progress(self, training_results, n_episodes, active):
+        status = []
+        for i, agent in enumerate(self.agents):
+            solved, min_ret, mean_ret = agent.evaluate_stopping_criterion(
+                        list_of_returns=training_results[i]['epsiode_returns'])
+            status.append("seed {0}: {1} episodes, mean return {2:.1f}{3}".format(
+                        self.seeds[i], n_episodes[i], mean_ret,
+                        " (solved)" if training_results[i]['training_completed'] else ""))
+        print("| " + " | ".join(status))
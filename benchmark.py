@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+'''
+    Microbenchmarks for the hot paths of agent.py.
+
+    Run
+        python benchmark.py --output benchmark.json
+    to time all benchmarks and write the results as JSON, and
+        python benchmark.py --baseline benchmark.json
+    to compare a new run against stored results. Benchmarks that became
+    slower than the baseline by more than --tolerance (relative) are listed
+    as regressions and the script exits with status 1.
+
+    With --end-to-end, the script also measures environment steps and
+    gradient steps per second through dqn.train on the synthetic stand-in
+    environment from environments.py, which separates agent overhead from
+    Box2D cost.
+
+    With --memory-dtype, the script trains with replay memories that store
+    observations and rewards as float32, float16 and bfloat16 from the same
+    seeds and reports memory footprint and the drift of the mean return
+    relative to float32.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+import warnings
+import numpy as np
+import torch
+import gymnasium as gym
+
+import agent
+import environments
+import numpy_policy
+
+N_STATE = 8
+N_ACTIONS = 4
+
+N_MEMORY = [20000, 200000]
+BATCH_SIZE = [32, 128]
+LAYERS = [[N_STATE,128,32,N_ACTIONS], [N_STATE,256,256,N_ACTIONS]]
+ACT_BATCH_SIZE = [16, 256]
+N_ENVS = [1, 8]
+STEP_TIME = [0., 1e-4]
+MEMORY_DTYPES = ['float32', 'float16', 'bfloat16']
+COMPILE_MODES = ['script', 'compile']
+
+
+def time_function(function, number, repeat):
+    '''Return the best time per call of function over repeat runs'''
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def get_agent(n_memory=20000, batch_size=32, layers=LAYERS[0], fill=True, compile_mode=None):
+    parameters = {'N_state':N_STATE, 'N_actions':N_ACTIONS,
+                  'n_memory':n_memory, 'batch_size':batch_size,
+                  'compile_mode':compile_mode,
+                  'neural_networks':{'policy_net':{'layers':layers},
+                                     'target_net':{'layers':layers}}}
+    my_agent = agent.dqn(parameters=parameters)
+    if fill:
+        fill_memory(my_agent.memory, n_memory)
+    return my_agent
+
+
+def fill_memory(memory, n_transitions, chunk_size=10000):
+    for start in range(0, n_transitions, chunk_size):
+        n = min(chunk_size, n_transitions - start)
+        memory.push_batch(np.random.randn(n, N_STATE).astype(np.float32),
+                          np.random.randint(N_ACTIONS, size=n),
+                          np.random.randn(n, N_STATE).astype(np.float32),
+                          np.random.randn(n).astype(np.float32),
+                          np.random.rand(n) < 0.01)
+
+
+def benchmark_memory_push(n_memory, **kwargs):
+    my_agent = get_agent(n_memory=n_memory)
+    state = np.random.randn(N_STATE).astype(np.float32)
+    return lambda: my_agent.memory.push(state, 1, state, 0.5, False)
+
+
+def benchmark_memory_sample(n_memory, batch_size, **kwargs):
+    my_agent = get_agent(n_memory=n_memory)
+    return lambda: my_agent.memory.sample(batch_size=batch_size)
+
+
+def benchmark_get_samples_from_memory(n_memory, batch_size, **kwargs):
+    my_agent = get_agent(n_memory=n_memory, batch_size=batch_size)
+    return my_agent.get_samples_from_memory
+
+
+def benchmark_act(layers, compile_mode=None, **kwargs):
+    my_agent = get_agent(layers=layers, fill=False, compile_mode=compile_mode)
+    state = np.random.randn(N_STATE).astype(np.float32)
+    return lambda: my_agent.act(state=state)
+
+
+def benchmark_act_batch(layers, n_states, **kwargs):
+    my_agent = get_agent(layers=layers, fill=False)
+    states = np.random.randn(n_states, N_STATE).astype(np.float32)
+    return lambda: my_agent.act_batch(states=states)
+
+
+def benchmark_numpy_policy_act(layers, **kwargs):
+    my_agent = get_agent(layers=layers, fill=False)
+    filename = os.path.join(tempfile.mkdtemp(), 'policy.npz')
+    agent.export_numpy_policy(state=my_agent.get_state(), filename=filename)
+    policy = numpy_policy.numpy_policy(filename)
+    state = np.random.randn(N_STATE).astype(np.float32)
+    return lambda: policy.act(state)
+
+
+def benchmark_run_optimization_step(n_memory, batch_size, layers, compile_mode=None, **kwargs):
+    my_agent = get_agent(n_memory=n_memory, batch_size=batch_size, layers=layers,
+                         compile_mode=compile_mode)
+    return lambda: my_agent.run_optimization_step(epoch=0)
+
+
+def benchmark_soft_update_target_net(layers, **kwargs):
+    my_agent = get_agent(layers=layers, fill=False)
+    return my_agent.soft_update_target_net
+
+
+def benchmark_get_state(layers, **kwargs):
+    my_agent = get_agent(layers=layers, n_memory=1000)
+    my_agent.run_optimization_step(epoch=0) # populate the optimizer state
+    return my_agent.get_state
+
+
+def benchmark_load_state(layers, **kwargs):
+    my_agent = get_agent(layers=layers, n_memory=1000)
+    my_agent.run_optimization_step(epoch=0)
+    state = my_agent.get_state()
+    return lambda: my_agent.load_state(state)
+
+
+def benchmark_save_dictionary(n_episodes, **kwargs):
+    my_agent = get_agent(fill=False)
+    training_results = {'episode_durations':list(np.random.randint(100, 1000, size=n_episodes)),
+                        'epsiode_returns':list(np.random.randn(n_episodes)),
+                        'n_training_epochs':list(np.arange(n_episodes)),
+                        'n_steps_simulated':list(np.arange(n_episodes)),
+                        'training_completed':False}
+    filename = os.path.join(tempfile.mkdtemp(), 'training.h5')
+    return lambda: my_agent.save_dictionary(dictionary=training_results, filename=filename)
+
+
+def benchmark_batched_lunar_lander_step(n_envs, **kwargs):
+    environment = environments.batched_lunar_lander(num_envs=n_envs, seed=0)
+    environment.reset()
+    actions = np.random.randint(N_ACTIONS, size=n_envs)
+    return lambda: environment.step(actions)
+
+
+def get_benchmarks():
+    '''Return a list of (name, setup function, parameters, number of calls per run)'''
+    benchmarks = []
+    for n_memory in N_MEMORY:
+        benchmarks.append(('memory.push', benchmark_memory_push,
+                           {'n_memory':n_memory}, 10000))
+        for batch_size in BATCH_SIZE:
+            parameters = {'n_memory':n_memory, 'batch_size':batch_size}
+            benchmarks.append(('memory.sample', benchmark_memory_sample,
+                               parameters, 1000))
+            benchmarks.append(('get_samples_from_memory',
+                               benchmark_get_samples_from_memory, parameters, 1000))
+    for layers in LAYERS:
+        benchmarks.append(('dqn.act', benchmark_act, {'layers':layers}, 2000))
+        benchmarks.append(('numpy_policy.act', benchmark_numpy_policy_act, {'layers':layers}, 2000))
+        for n_states in ACT_BATCH_SIZE:
+            benchmarks.append(('dqn.act_batch', benchmark_act_batch,
+                               {'layers':layers, 'n_states':n_states}, 1000))
+        for batch_size in BATCH_SIZE:
+            benchmarks.append(('run_optimization_step',
+                               benchmark_run_optimization_step,
+                               {'n_memory':N_MEMORY[0], 'batch_size':batch_size,
+                                'layers':layers}, 200))
+        benchmarks.append(('soft_update_target_net',
+                           benchmark_soft_update_target_net, {'layers':layers}, 2000))
+        benchmarks.append(('get_state', benchmark_get_state, {'layers':layers}, 200))
+        benchmarks.append(('load_state', benchmark_load_state, {'layers':layers}, 50))
+    for compile_mode in COMPILE_MODES:
+        benchmarks.append(('dqn.act', benchmark_act,
+                           {'layers':LAYERS[0], 'compile_mode':compile_mode}, 2000))
+        benchmarks.append(('run_optimization_step', benchmark_run_optimization_step,
+                           {'n_memory':N_MEMORY[0], 'batch_size':BATCH_SIZE[0],
+                            'layers':LAYERS[0], 'compile_mode':compile_mode}, 200))
+    for n_envs in [1024, 16384]:
+        benchmarks.append(('batched_lunar_lander.step',
+                           benchmark_batched_lunar_lander_step, {'n_envs':n_envs}, 100))
+    for n_episodes in [1000, 10000]:
+        benchmarks.append(('save_dictionary', benchmark_save_dictionary,
+                           {'n_episodes':n_episodes}, 20))
+    return benchmarks
+
+
+def benchmark_train(n_envs, step_time, n_episodes, episode_length=200):
+    '''Return environment steps and gradient steps per second through train'''
+    my_agent = get_agent(fill=False)
+    my_agent.n_episodes_max = n_episodes
+    make_environment = lambda: environments.synthetic_lunar_lander(
+                        episode_length=episode_length, step_time=step_time)
+    if n_envs == 1:
+        environment = make_environment()
+    else:
+        environment = gym.vector.SyncVectorEnv([make_environment for _ in range(n_envs)])
+    environment.reset(seed=0)
+    start_time = time.perf_counter()
+    with warnings.catch_warnings(): # the stopping criterion is never met
+        warnings.simplefilter('ignore')
+        training_results = my_agent.train(environment=environment, verbose=False)
+    elapsed_time = time.perf_counter() - start_time
+    n_steps = training_results['n_steps_simulated'][-1]
+    n_epochs = training_results['n_training_epochs'][-1]
+    return {'time_per_call':elapsed_time/n_steps,
+            'steps_per_second':n_steps/elapsed_time,
+            'gradient_steps_per_second':n_epochs/elapsed_time}
+
+
+def run_end_to_end_benchmarks(n_episodes=20, verbose=True):
+    results = []
+    for n_envs in N_ENVS:
+        for step_time in STEP_TIME:
+            parameters = {'n_envs':n_envs, 'step_time':step_time, 'n_episodes':n_episodes}
+            result = {'name':'train', 'parameters':parameters}
+            result.update(benchmark_train(**parameters))
+            results.append(result)
+            if verbose:
+                print("{0:70s} {1:10.0f} steps/s {2:10.0f} gradient steps/s".format(
+                        get_key(result), result['steps_per_second'],
+                        result['gradient_steps_per_second']))
+    return results
+
+
+def benchmark_memory_dtype(dtype, n_episodes, seeds=(0, 1, 2), episode_length=200):
+    '''Return memory footprint and mean training return for a replay memory dtype'''
+    mean_returns = []
+    elapsed_time = 0.
+    n_steps = 0
+    for seed in seeds:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        my_agent = agent.dqn(parameters={'N_state':N_STATE, 'N_actions':N_ACTIONS,
+                                         'memory_dtype':dtype,
+                                         'n_episodes_max':n_episodes})
+        environment = environments.synthetic_lunar_lander(episode_length=episode_length)
+        environment.reset(seed=seed)
+        start_time = time.perf_counter()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            training_results = my_agent.train(environment=environment, verbose=False)
+        elapsed_time += time.perf_counter() - start_time
+        n_steps += training_results['n_steps_simulated'][-1]
+        mean_returns.append(np.mean(training_results['epsiode_returns']))
+    return {'time_per_call':elapsed_time/n_steps,
+            'memory_nbytes':my_agent.memory.nbytes,
+            'mean_return':float(np.mean(mean_returns))}
+
+
+def run_memory_dtype_benchmarks(n_episodes=20, verbose=True):
+    results = []
+    for dtype in MEMORY_DTYPES:
+        parameters = {'dtype':dtype, 'n_episodes':n_episodes}
+        result = {'name':'memory_dtype', 'parameters':parameters}
+        result.update(benchmark_memory_dtype(**parameters))
+        result['return_drift'] = result['mean_return'] - results[0]['mean_return'] if results else 0.
+        results.append(result)
+        if verbose:
+            print("{0:70s} {1:8.2f} MB  mean return {2:9.3f}  drift {3:+8.3f}".format(
+                    get_key(result), result['memory_nbytes']/2**20,
+                    result['mean_return'], result['return_drift']))
+    return results
+
+
+def get_key(result):
+    return result['name'] + ' ' + json.dumps(result['parameters'], sort_keys=True)
+
+
+def run_benchmarks(repeat=5, scale=1., filter_string=None, verbose=True):
+    results = []
+    for name, setup, parameters, number in get_benchmarks():
+        if filter_string is not None and filter_string not in name:
+            continue
+        function = setup(**parameters)
+        number = max(1, int(number*scale))
+        function() # warm-up
+        time_per_call = time_function(function, number=number, repeat=repeat)
+        result = {'name':name, 'parameters':parameters, 'time_per_call':time_per_call}
+        results.append(result)
+        if verbose:
+            print("{0:70s} {1:12.3f} us".format(get_key(result), 1e6*time_per_call))
+    return results
+
+
+def get_metadata():
+    return {'python':platform.python_version(),
+            'numpy':np.__version__,
+            'torch':torch.__version__,
+            'platform':platform.platform(),
+            'processor':platform.processor(),
+            'torch_num_threads':torch.get_num_threads()}
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    '''Return list of (key, baseline time, current time) for all regressions'''
+    baseline_times = {get_key(result):result['time_per_call'] for result in baseline['results']}
+    regressions = []
+    for result in results:
+        key = get_key(result)
+        if key not in baseline_times:
+            continue
+        if result['time_per_call'] > (1. + tolerance)*baseline_times[key]:
+            regressions.append((key, baseline_times[key], result['time_per_call']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for agent.py")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--baseline', help="JSON file with stored results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed relative slowdown before a benchmark counts as regression")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.,
+                        help="scale the number of calls per run, e.g. 0.1 for a quick run")
+    parser.add_argument('--filter', help="only run benchmarks whose name contains this string")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end-to-end', action='store_true',
+                        help="also measure steps per second through dqn.train")
+    parser.add_argument('--memory-dtype', action='store_true',
+                        help="also compare float32, float16 and bfloat16 replay memories")
+    parser.add_argument('--episodes', type=int, default=20,
+                        help="number of training episodes for the end-to-end and memory dtype benchmarks")
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    results = run_benchmarks(repeat=args.repeat, scale=args.scale,
+                             filter_string=args.filter)
+    if args.end_to_end:
+        results += run_end_to_end_benchmarks(n_episodes=args.episodes)
+    if args.memory_dtype:
+        results += run_memory_dtype_benchmarks(n_episodes=args.episodes)
+    output = {'metadata':get_metadata(), 'results':results}
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results=results, baseline=baseline,
+                                          tolerance=args.tolerance)
+        for key, baseline_time, current_time in regressions:
+            print("REGRESSION {0}: {1:.3f} us -> {2:.3f} us ({3:+.1f}%)".format(key,
+                    1e6*baseline_time, 1e6*current_time,
+                    100*(current_time/baseline_time - 1.)))
+        if regressions:
+            sys.exit(1)
+        print("No regressions compared to {0}".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
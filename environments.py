@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+'''
+    Lightweight stand-in environments with the shapes of LunarLander-v2
+    (8-dimensional observation, 4 discrete actions). They only need NumPy
+    and gymnasium, so they run on machines without box2d or pygame.
+'''
+
+import time
+import numpy as np
+import gymnasium as gym
+
+
+'''
+    Synthetic, deterministic environment with the gymnasium API and the
+    observation and action shapes of LunarLander-v2. The observation follows
+    fixed random linear dynamics driven by the action; the reward is
+    highest close to the origin. For benchmarking the cost of an environment
+    step can be tuned with step_time (seconds of busy waiting per step) and
+    the episode length with episode_length.
+'''
+class synthetic_lunar_lander(gym.Env):
+
+    metadata = {'render_modes':[]}
+
+    def __init__(self, episode_length=200, step_time=0., n_state=8, n_actions=4, dynamics_seed=0):
+        self.episode_length = episode_length
+        self.step_time = step_time
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(n_state,), dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(n_actions)
+        # fixed dynamics, independent of the seed passed to reset
+        rng = np.random.default_rng(dynamics_seed)
+        self.transition_matrix = (0.95*np.linalg.qr(rng.standard_normal((n_state, n_state)))[0]).astype(np.float32)
+        self.action_effects = (0.1*rng.standard_normal((n_actions, n_state))).astype(np.float32)
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.t = 0
+        self.state = self.np_random.uniform(-1., 1., size=self.observation_space.shape).astype(np.float32)
+        return self.state.copy(), {}
+
+    def step(self, action):
+        if self.step_time > 0:
+            end_time = time.perf_counter() + self.step_time
+            while time.perf_counter() < end_time:
+                pass
+        noise = 0.01*self.np_random.standard_normal(self.observation_space.shape)
+        self.state = (self.transition_matrix @ self.state + self.action_effects[action] + noise).astype(np.float32)
+        self.t += 1
+        reward = 1. - float(np.linalg.norm(self.state))
+        truncated = self.t >= self.episode_length
+        return self.state.copy(), reward, False, truncated, {}
+
+
+'''
+    Batched, simplified LunarLander: num_envs landers are simulated at once
+    with NumPy array math. Each lander is a rigid body with a main engine
+    (action 2) that pushes along its axis, two side engines (actions 1 and 3)
+    that push sideways and rotate it, and two legs whose ground contact is
+    reported in the observation. Rewards follow the shaping of LunarLander-v2
+    (distance to the landing pad, speed, tilt, leg contact and fuel use, 
+    -100 for crashing or leaving the screen, +100 for coming to rest). The 
+    observation is normalized like the one of LunarLander-v2.
+
+    The class follows the gymnasium 0.29 vector environment API used by
+    agent_base.train: step takes an array of num_envs actions and returns
+    arrays, finished landers are reset automatically, and their final
+    observations are passed in info['final_observation'] (rows of finished
+    landers) together with the mask info['_final_observation'].
+'''
+class batched_lunar_lander(object):
+
+    fps = 50
+    gravity = -10.
+    main_engine_acceleration = 15. # along the lander axis
+    side_engine_acceleration = 1.5 # sideways
+    side_engine_angular_acceleration = 3.
+    half_width = 10. # half width of the screen, in world units
+    half_height = 20./3. # half height of the screen, in world units
+    initial_height = 20./3. + 10./3. - 0.6 # height of the legs above the landing pad at reset
+    leg_offset = 0.67 # horizontal distance of the legs from the lander center
+    crash_speed = 4. # maximal vertical speed at touchdown
+    crash_angle = 0.8 # maximal tilt at touchdown
+    rest_speed = 0.05 # landers slower than this with both legs down are at rest
+    max_episode_steps = 1000
+
+    def __init__(self, num_envs=1024, seed=None):
+        self.num_envs = num_envs
+        self.single_observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(8,), dtype=np.float32)
+        self.single_action_space = gym.spaces.Discrete(4)
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(num_envs, 8), dtype=np.float32)
+        self.action_space = gym.spaces.MultiDiscrete(np.full(num_envs, 4))
+        self.rng = np.random.default_rng(seed)
+        
+        # state of all landers
+        self.position = np.zeros((num_envs, 2)) # x relative to the pad center, y of the legs above the pad
+        self.velocity = np.zeros((num_envs, 2))
+        self.angle = np.zeros(num_envs)
+        self.angular_velocity = np.zeros(num_envs)
+        self.leg_contact = np.zeros((num_envs, 2), dtype=bool)
+        self.previous_shaping = np.zeros(num_envs)
+        self.t = np.zeros(num_envs, dtype=np.int64)
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.reset_landers(np.ones(self.num_envs, dtype=bool))
+        return self.get_observation(), {}
+
+    def reset_landers(self, mask):
+        n = int(mask.sum())
+        self.position[mask] = [0., self.initial_height]
+        # LunarLander-v2 starts with a random push of the lander
+        self.velocity[mask] = self.rng.uniform(-1., 1., size=(n, 2)) * [2., 1.]
+        self.angle[mask] = 0.
+        self.angular_velocity[mask] = 0.
+        self.leg_contact[mask] = False
+        self.t[mask] = 0
+        self.previous_shaping[mask] = self.get_shaping()[mask]
+
+    def get_observation(self):
+        return np.column_stack([
+                    self.position[:,0]/self.half_width,
+                    self.position[:,1]/self.half_height,
+                    self.velocity[:,0]*self.half_width/self.fps,
+                    self.velocity[:,1]*self.half_height/self.fps,
+                    self.angle,
+                    20.*self.angular_velocity/self.fps,
+                    self.leg_contact[:,0],
+                    self.leg_contact[:,1]]).astype(np.float32)
+
+    def get_shaping(self):
+        observation = self.get_observation()
+        return (- 100*np.sqrt(observation[:,0]**2 + observation[:,1]**2)
+                - 100*np.sqrt(observation[:,2]**2 + observation[:,3]**2)
+                - 100*np.abs(observation[:,4])
+                + 10*observation[:,6] + 10*observation[:,7])
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        dt = 1./self.fps
+        main_engine = actions == 2
+        left_engine = actions == 1 # fires to the left, pushes the lander right
+        right_engine = actions == 3
+        side = left_engine.astype(np.float64) - right_engine
+        
+        # engine impulses in the frame of the lander, gravity in world frame
+        sin, cos = np.sin(self.angle), np.cos(self.angle)
+        acceleration = np.zeros((self.num_envs, 2))
+        acceleration[:,0] = (-sin*self.main_engine_acceleration*main_engine
+                             + cos*self.side_engine_acceleration*side)
+        acceleration[:,1] = (cos*self.main_engine_acceleration*main_engine
+                             + sin*self.side_engine_acceleration*side
+                             + self.gravity)
+        self.velocity += acceleration*dt
+        self.position += self.velocity*dt
+        self.angular_velocity -= side*self.side_engine_angular_acceleration*dt
+        self.angle += self.angular_velocity*dt
+        
+        # legs touching the ground carry the lander: no sinking into the
+        # ground, friction and levelling torque
+        legs_height = self.position[:,1,None] + np.array([-1., 1.])*self.leg_offset*np.sin(self.angle)[:,None]
+        self.leg_contact = legs_height <= 0.
+        touching = self.leg_contact.any(axis=1)
+        crashed = touching & ((self.velocity[:,1] < -self.crash_speed)
+                              | (np.abs(self.angle) > self.crash_angle))
+        self.position[touching,1] -= legs_height[touching].min(axis=1)
+        self.velocity[touching,1] = np.maximum(self.velocity[touching,1], 0.)
+        self.velocity[touching,0] *= 0.9
+        self.angular_velocity[touching] *= 0.8
+        self.angle[touching] *= 0.9
+        
+        outside = np.abs(self.position[:,0]) >= self.half_width
+        at_rest = (self.leg_contact.all(axis=1)
+                   & (np.abs(self.velocity).max(axis=1) < self.rest_speed)
+                   & (np.abs(self.angular_velocity) < self.rest_speed))
+        
+        shaping = self.get_shaping()
+        rewards = shaping - self.previous_shaping
+        self.previous_shaping = shaping
+        rewards -= 0.30*main_engine + 0.03*(left_engine | right_engine) # fuel
+        rewards[at_rest] = 100.
+        rewards[crashed | outside] = -100.
+        
+        self.t += 1
+        terminated = crashed | outside | at_rest
+        truncated = ~terminated & (self.t >= self.max_episode_steps)
+        observation = self.get_observation()
+        
+        info = {}
+        done = terminated | truncated
+        if done.any():
+            info['final_observation'] = observation.copy()
+            info['_final_observation'] = done
+            self.reset_landers(done)
+            observation[done] = self.get_observation()[done]
+        return observation, rewards, terminated, truncated, info
+
+    def close(self):
+        pass
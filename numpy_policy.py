@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+    Greedy inference for policies trained with agent.dqn, using only NumPy.
+    Importing this module does not import torch, which makes it cheap for
+    short-lived evaluation processes. Export the policy net once with
+        agent.export_numpy_policy(state=my_agent.get_state(), filename='policy.npz')
+    and load it with
+        policy = numpy_policy('policy.npz')
+        action = policy.act(state)
+'''
+
+import numpy as np
+
+
+'''
+    Feedforward ReLU network with the weights of agent.neural_network,
+    evaluated with np.dot and np.maximum.
+'''
+class numpy_policy(object):
+
+    def __init__(self, filename):
+        with np.load(filename) as arrays:
+            n_layers = len([name for name in arrays.files if name.startswith('weight_')])
+            self.weights = [np.ascontiguousarray(arrays[f'weight_{i}'], dtype=np.float32)
+                            for i in range(n_layers)]
+            self.biases = [np.ascontiguousarray(arrays[f'bias_{i}'], dtype=np.float32)
+                           for i in range(n_layers)]
+        self.n_state = self.weights[0].shape[0]
+        self.n_actions = self.weights[-1].shape[1]
+
+    def get_q_values(self, states):
+        '''Return the Q values for a batch of states (N, n_state)'''
+        x = np.asarray(states, dtype=np.float32)
+        for weight, bias in zip(self.weights[:-1], self.biases[:-1]):
+            x = np.dot(x, weight)
+            x += bias
+            np.maximum(x, 0., out=x)
+        x = np.dot(x, self.weights[-1])
+        x += self.biases[-1]
+        return x
+
+    def act(self, state, epsilon=0.0):
+        if epsilon > 0. and np.random.rand() < epsilon:
+            return np.random.randint(self.n_actions)
+        return int(self.get_q_values(np.asarray(state)[None]).argmax())
+
+    def act_batch(self, states, epsilon=0.0):
+        '''Return epsilon-greedy actions for a batch of states (N, n_state)'''
+        actions = self.get_q_values(states).argmax(axis=1)
+        if epsilon > 0.:
+            explore = np.random.rand(len(actions)) < epsilon
+            actions[explore] = np.random.randint(0, self.n_actions, size=explore.sum())
+        return actions
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+'''
+    Population-based training (Jaderberg et al., 2017) of agent.dqn.
+
+    Every member of the population is a dqn agent that lives in its own
+    worker process together with its environment and replay memory. After
+    every interval of training episodes, the members are ranked by the mean
+    return of their last n_solving_episodes episodes (as in
+    evaluate_stopping_criterion). Each member in the bottom fraction then
+    copies weights and optimizer state of a random member of the top
+    fraction through get_state/load_state (exploit) and perturbs the
+    learning rate, the epsilon decay d_epsilon and the target net update
+    tau (explore); its own replay memory is kept. Training stops as soon as
+    one member meets its stopping criterion.
+
+        python pbt.py --population-size 8 --interval 50 --output-dir pbt
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import warnings
+import numpy as np
+import torch
+
+import agent
+import sweep
+
+def get_hyperparameters(my_agent):
+    return {'lr':my_agent.optimizers['policy_net'].param_groups[0]['lr'],
+            'd_epsilon':my_agent.d_epsilon,
+            'target_net_update_tau':my_agent.target_net_update_tau}
+
+
+def set_hyperparameters(my_agent, hyperparameters):
+    '''Apply hyperparameters to the agent and its parameters dictionary'''
+    for param_group in my_agent.optimizers['policy_net'].param_groups:
+        param_group['lr'] = hyperparameters['lr']
+    my_agent.parameters['optimizers']['policy_net']['optimizer_args']['lr'] = hyperparameters['lr']
+    my_agent.d_epsilon = hyperparameters['d_epsilon']
+    my_agent.parameters['d_epsilon'] = hyperparameters['d_epsilon']
+    my_agent.target_net_update_tau = hyperparameters['target_net_update_tau']
+    my_agent.parameters['target_net_update_tau'] = hyperparameters['target_net_update_tau']
+
+
+def perturb_hyperparameters(hyperparameters, rng, factors=(0.8, 1.25)):
+    perturbed = {name:value*rng.choice(factors) for name, value in hyperparameters.items()}
+    perturbed['target_net_update_tau'] = min(perturbed['target_net_update_tau'], 1.)
+    return perturbed
+
+
+def run_member(connection, environment_name, parameters, hyperparameters, seed):
+    '''
+    Worker process of one population member. Commands received through
+    connection:
+        ('train', n_episodes) -> (mean return, solved, number of episodes)
+        ('get_state', None) -> (state of the agent, current epsilon)
+        ('exploit', (state, epsilon, hyperparameters)) -> None
+        ('stop', None)
+    '''
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    environment = sweep.make_environment(environment_name)
+    environment.reset(seed=seed)
+    my_agent = agent.dqn(parameters=parameters)
+    set_hyperparameters(my_agent, hyperparameters)
+    episode_returns = []
+
+    while True:
+        command, argument = connection.recv()
+        if command == 'train':
+            my_agent.n_episodes_max = argument
+            with warnings.catch_warnings(): # the interval usually ends before solving
+                warnings.simplefilter('ignore')
+                training_results = my_agent.train(environment=environment, verbose=False)
+            episode_returns += training_results['epsiode_returns']
+            solved, min_return, mean_return = my_agent.evaluate_stopping_criterion(
+                                                    list_of_returns=episode_returns)
+            # rank on the available episodes until there are n_solving_episodes
+            mean_return = np.mean(episode_returns[-my_agent.n_solving_episodes:])
+            connection.send((float(mean_return), bool(solved), len(episode_returns)))
+        elif command == 'get_state':
+            connection.send((my_agent.get_state(), my_agent.epsilon))
+        elif command == 'exploit':
+            state, epsilon, hyperparameters = argument
+            # load_state re-initializes the agent; keep the own replay memory
+            # and on-disk memory_path instead of adopting the donor's
+            replay_memory = my_agent.memory
+            my_agent.load_state(dict(state, parameters=dict(state['parameters'],
+                                                            memory_path=my_agent.memory_path)))
+            my_agent.memory = replay_memory
+            my_agent.epsilon = epsilon
+            set_hyperparameters(my_agent, hyperparameters)
+            connection.send(None)
+        elif command == 'stop':
+            environment.close()
+            connection.close()
+            return
+
+
+def run_pbt(parameters, environment_name='LunarLander-v2', population_size=8,
+            interval=50, n_generations=100, truncation_fraction=0.25, seed=0,
+            output_dir=None, verbose=True):
+    '''
+    Run population-based training and return the state (see
+    agent_base.get_state) of the best member together with the history of
+    all generations
+    '''
+    if n_generations < 1:
+        raise RuntimeError("run_pbt needs n_generations >= 1.")
+    rng = np.random.default_rng(seed)
+    reference_agent = agent.dqn(parameters=dict(parameters, memory_path=None))
+    default_hyperparameters = get_hyperparameters(reference_agent)
+
+    # initial population: perturbed default hyperparameters
+    hyperparameters = [default_hyperparameters] + [
+                        perturb_hyperparameters(default_hyperparameters, rng)
+                        for _ in range(population_size - 1)]
+    context = multiprocessing.get_context('spawn')
+    connections = []
+    workers = []
+    for i in range(population_size):
+        member_parameters = parameters
+        if parameters.get('memory_path') is not None: # one on-disk memory per member
+            member_parameters = dict(parameters, memory_path=os.path.join(
+                                        parameters['memory_path'], f'member_{i}'))
+        connection, worker_connection = context.Pipe()
+        worker = context.Process(target=run_member,
+                                 args=(worker_connection, environment_name, member_parameters,
+                                       hyperparameters[i], seed + i),
+                                 daemon=True)
+        worker.start()
+        connections.append(connection)
+        workers.append(worker)
+
+    history = []
+    n_exploit = max(1, int(truncation_fraction*population_size))
+    try:
+        for generation in range(n_generations):
+            for connection in connections:
+                connection.send(('train', interval))
+            results = [connection.recv() for connection in connections]
+            mean_returns = np.array([mean_return for mean_return, solved, n_episodes in results])
+            solved = [solved for mean_return, solved, n_episodes in results]
+            history.append({'generation':generation,
+                            'mean_returns':mean_returns.tolist(),
+                            'n_episodes':[n_episodes for mean_return, solved, n_episodes in results],
+                            'hyperparameters':[dict(h) for h in hyperparameters]})
+            if verbose:
+                print("| generation {0: 4d} | best mean return {1: 9.3f} | median {2: 9.3f} |".format(
+                        generation, mean_returns.max(), np.median(mean_returns)))
+            if any(solved):
+                break
+
+            ranking = np.argsort(mean_returns)
+            bottom, top = ranking[:n_exploit], ranking[-n_exploit:]
+            for i in bottom:
+                donor = rng.choice(top)
+                connections[donor].send(('get_state', None))
+                state, epsilon = connections[donor].recv()
+                hyperparameters[i] = perturb_hyperparameters(hyperparameters[donor], rng)
+                connections[i].send(('exploit', (state, epsilon, hyperparameters[i])))
+                connections[i].recv()
+
+        best = int(np.argmax(mean_returns))
+        connections[best].send(('get_state', None))
+        best_state, epsilon = connections[best].recv()
+    finally:
+        for connection in connections:
+            try:
+                connection.send(('stop', None))
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in workers:
+            worker.join()
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, 'history.json'), 'w') as f:
+            json.dump(history, f, indent=1)
+        torch.save(best_state, os.path.join(output_dir, 'best_member.pt'))
+
+    return best_state, history
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Population-based training of agent.dqn")
+    parser.add_argument('--environment', default='LunarLander-v2',
+                        help="gymnasium environment id, or synthetic_lunar_lander / batched_lunar_lander")
+    parser.add_argument('--population-size', type=int, default=8)
+    parser.add_argument('--interval', type=int, default=50,
+                        help="number of training episodes between exploit/explore steps")
+    parser.add_argument('--n-generations', type=int, default=100)
+    parser.add_argument('--truncation-fraction', type=float, default=0.25)
+    parser.add_argument('--output-dir', default='pbt')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    environment = sweep.make_environment(args.environment)
+    if agent.is_vector_environment(environment):
+        n_state = environment.single_observation_space.shape[0]
+        n_actions = environment.single_action_space.n
+    else:
+        n_state = environment.observation_space.shape[0]
+        n_actions = environment.action_space.n
+    environment.close()
+
+    run_pbt(parameters={'N_state':n_state, 'N_actions':n_actions},
+            environment_name=args.environment,
+            population_size=args.population_size, interval=args.interval,
+            n_generations=args.n_generations,
+            truncation_fraction=args.truncation_fraction,
+            seed=args.seed, output_dir=args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
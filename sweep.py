@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+'''
+    Hyperparameter sweeps over the parameters of agent.dqn.
+
+    A search space is a JSON file that maps parameter names to the values to
+    try, e.g.
+        {"lr": [1e-4, 1e-3],
+         "batch_size": [32, 64],
+         "training_stride": [1, 5],
+         "target_net_update_tau": {"log_uniform": [1e-3, 1e-1]},
+         "d_epsilon": [5e-5, 1e-4],
+         "layers": [[128, 32], [256, 64]],
+         "doubledqn": [false, true]}
+    "lr" sets the learning rate of the optimizer and "layers" the hidden
+    layers of policy and target net; all other names are keys of
+    dqn.get_default_parameters. Lists of values are combined into a full
+    grid (--mode grid) or sampled from (--mode random, together with
+    {"uniform": [low, high]} and {"log_uniform": [low, high]} ranges).
+
+    Every run trains dqn(parameters).train(...) in a process pool with one
+    torch thread per worker. The training results of each finished run are
+    appended to the results table results.jsonl in the output directory.
+    A run is identified by its configuration, seed, environment and fixed
+    parameters (e.g. --n-episodes-max). Running the same sweep again skips
+    completed runs and retries failed ones, so an interrupted sweep can 
+    simply be restarted:
+        python sweep.py --search-space space.json --output-dir sweep
+'''
+
+import argparse
+import concurrent.futures
+import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+import warnings
+import numpy as np
+import torch
+import gymnasium as gym
+
+import agent
+import environments
+
+RESULTS_FILENAME = 'results.jsonl'
+
+
+def get_grid_configurations(search_space):
+    names = sorted(search_space.keys())
+    for name in names:
+        if not isinstance(search_space[name], list):
+            raise RuntimeError(f"Grid search needs a list of values for '{name}'.")
+    return [dict(zip(names, values))
+            for values in itertools.product(*[search_space[name] for name in names])]
+
+
+def sample_value(values, rng):
+    if isinstance(values, list):
+        return values[rng.integers(len(values))]
+    elif 'uniform' in values:
+        low, high = values['uniform']
+        return float(rng.uniform(low, high))
+    elif 'log_uniform' in values:
+        low, high = values['log_uniform']
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    raise RuntimeError(f"Unknown search space entry {values}.")
+
+
+def get_random_configurations(search_space, n_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{name:sample_value(values, rng) for name, values in sorted(search_space.items())}
+            for _ in range(n_samples)]
+
+
+def get_run_id(configuration, seed, environment_name, fixed_parameters):
+    key = json.dumps({'configuration':configuration, 'seed':seed,
+                      'environment_name':environment_name,
+                      'fixed_parameters':fixed_parameters}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def get_parameters(configuration, n_state, n_actions):
+    '''Turn a sweep configuration into the parameters dictionary of dqn'''
+    parameters = {'N_state':n_state, 'N_actions':n_actions}
+    for name, value in configuration.items():
+        if name == 'lr':
+            parameters['optimizers'] = {'policy_net':{'optimizer':'RMSprop',
+                                                      'optimizer_args':{'lr':value}}}
+        elif name == 'layers':
+            layers = [n_state] + list(value) + [n_actions]
+            parameters['neural_networks'] = {'policy_net':{'layers':layers},
+                                             'target_net':{'layers':copy.deepcopy(layers)}}
+        else:
+            parameters[name] = value
+    return parameters
+
+
+def check_parameter_names(configurations, fixed_parameters):
+    '''Raise if a configuration sets a name that dqn does not know'''
+    reference_agent = agent.dqn(parameters={'N_state':1, 'N_actions':1, 'n_memory':1})
+    known_names = set(reference_agent.get_default_parameters().keys()) | {'lr', 'layers'}
+    for configuration in configurations + [fixed_parameters]:
+        unknown_names = sorted(name for name in configuration if name.lower() not in known_names)
+        if unknown_names:
+            raise RuntimeError(f"Unknown parameters {unknown_names} in sweep configuration {configuration}. "
+                               f"Use 'lr', 'layers' or keys of dqn.get_default_parameters.")
+
+
+def make_environment(environment_name):
+    '''Environment from gymnasium, or one of the stand-ins of environments.py'''
+    if environment_name == 'synthetic_lunar_lander':
+        return environments.synthetic_lunar_lander()
+    elif environment_name == 'batched_lunar_lander':
+        return environments.batched_lunar_lander(num_envs=16)
+    return gym.make(environment_name)
+
+
+def initialize_worker():
+    torch.set_num_threads(1)
+
+
+def run_configuration(run_id, configuration, environment_name, seed, fixed_parameters):
+    '''Train one configuration and return its entry of the results table'''
+    start_time = time.time()
+    entry = {'run_id':run_id, 'configuration':configuration, 'seed':seed,
+             'environment_name':environment_name, 'fixed_parameters':fixed_parameters}
+    try:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        environment = make_environment(environment_name)
+        environment.reset(seed=seed)
+        n_state = environment.single_observation_space.shape[0] if agent.is_vector_environment(environment) \
+                        else environment.observation_space.shape[0]
+        n_actions = environment.single_action_space.n if agent.is_vector_environment(environment) \
+                        else environment.action_space.n
+        parameters = get_parameters(configuration=configuration,
+                                    n_state=n_state, n_actions=n_actions)
+        parameters.update(fixed_parameters)
+        my_agent = agent.dqn(parameters=parameters)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            training_results = my_agent.train(environment=environment, verbose=False)
+        environment.close()
+        returns = training_results['epsiode_returns']
+        entry.update({'status':'completed',
+                      'training_completed':bool(training_results['training_completed']),
+                      'n_episodes':len(returns),
+                      'n_steps_simulated':int(training_results['n_steps_simulated'][-1]),
+                      'final_mean_return':float(np.mean(returns[-my_agent.n_solving_episodes:])),
+                      'training_results':training_results})
+    except Exception:
+        entry.update({'status':'failed', 'error':traceback.format_exc()})
+    entry['wall_time'] = time.time() - start_time
+    return entry
+
+
+def load_results(output_dir):
+    '''Return the latest entry of each run in the results table'''
+    results = {}
+    path = os.path.join(output_dir, RESULTS_FILENAME)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    results[entry['run_id']] = entry
+    return results
+
+
+def append_result(output_dir, entry):
+    with open(os.path.join(output_dir, RESULTS_FILENAME), 'a') as f:
+        f.write(json.dumps(entry, default=float) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_sweep(configurations, output_dir, environment_name='LunarLander-v2',
+              seed=0, n_workers=None, fixed_parameters=None, verbose=True):
+    '''
+    Train all configurations that have not been completed in an earlier run
+    of the sweep and return the results table as dictionary run_id -> entry
+    '''
+    if fixed_parameters is None:
+        fixed_parameters = {}
+    check_parameter_names(configurations, fixed_parameters)
+    os.makedirs(output_dir, exist_ok=True)
+    results = load_results(output_dir)
+    runs = {}
+    for configuration in configurations:
+        run_id = get_run_id(configuration, seed, environment_name, fixed_parameters)
+        if results.get(run_id, {}).get('status') != 'completed':
+            runs[run_id] = configuration
+    if verbose:
+        print(f"{len(configurations)} configurations, {len(configurations) - len(runs)} completed, {len(runs)} to run")
+    if not runs:
+        return results
+
+    n_cores = os.cpu_count() or 1
+    n_workers = n_cores if n_workers is None else min(n_workers, n_cores)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=initialize_worker) as executor:
+        futures = [executor.submit(run_configuration, run_id, configuration,
+                                   environment_name, seed, fixed_parameters)
+                   for run_id, configuration in runs.items()]
+        for future in concurrent.futures.as_completed(futures):
+            entry = future.result()
+            append_result(output_dir, entry)
+            results[entry['run_id']] = entry
+            if verbose:
+                if entry['status'] == 'completed':
+                    print("{0} completed in {1:.0f} s: {2} episodes, mean return {3:.1f}, {4}".format(
+                            entry['run_id'], entry['wall_time'], entry['n_episodes'],
+                            entry['final_mean_return'], entry['configuration']))
+                else:
+                    print("{0} failed: {1}".format(entry['run_id'],
+                                                   entry['error'].strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep for agent.dqn")
+    parser.add_argument('--search-space', required=True, help="JSON file with the search space")
+    parser.add_argument('--mode', choices=['grid', 'random'], default='grid')
+    parser.add_argument('--n-samples', type=int, default=20, help="number of random configurations")
+    parser.add_argument('--output-dir', default='sweep')
+    parser.add_argument('--environment', default='LunarLander-v2',
+                        help="gymnasium environment id, or synthetic_lunar_lander / batched_lunar_lander")
+    parser.add_argument('--workers', type=int, default=None, help="defaults to the number of cores")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-episodes-max', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.search_space, 'r') as f:
+        search_space = json.load(f)
+    if args.mode == 'grid':
+        configurations = get_grid_configurations(search_space)
+    else:
+        configurations = get_random_configurations(search_space, args.n_samples, seed=args.seed)
+    fixed_parameters = {}
+    if args.n_episodes_max is not None:
+        fixed_parameters['n_episodes_max'] = args.n_episodes_max
+
+    run_sweep(configurations=configurations, output_dir=args.output_dir,
+              environment_name=args.environment, seed=args.seed,
+              n_workers=args.workers, fixed_parameters=fixed_parameters)
+
+
+if __name__ == '__main__':
+    main()